@@ -1,63 +1,178 @@
+import asyncio
 import discord
 from discord.ext import commands
 from discord.ui import Button, View
 import datetime
-from utils import load_payments, save_payments, ensure_user_month, set_payment_status, is_month_paid, get_user_payments, month_translation, check_command_channel
-from user import PaymentView
+from utils import month_translation, check_command_channel
+from user import PaymentView, DigestPaymentView
 from views import ConfirmPaymentView
+from reminders import send_reminders, send_digest
+from summary import SUMMARY_MODES, display_name
+import metrics
+
+
+# Users per dashboard page, about 40 characters each
+PAGE_SIZE = 25
+MONTH_INITIALS = "J F M A M J J A S O N D"
+NAME_WIDTH = 16
+
+
+def due_mask(year, today):
+    """Returns the months of the year that are already due, as a bitmask."""
+    year = int(year)
+    if year < today.year:
+        return (1 << 12) - 1
+    if year > today.year:
+        return 0
+    return (1 << today.month) - 1
+
+
+class JumpToPageModal(discord.ui.Modal, title="Go to page"):
+    page = discord.ui.TextInput(label="Page number", max_length=6)
+
+    def __init__(self, dashboard):
+        super().__init__()
+        self.dashboard = dashboard
+
+    async def on_submit(self, interaction: discord.Interaction):
+        if not self.page.value.strip().isdigit():
+            await interaction.response.send_message(
+                "Please enter a page number.", ephemeral=True)
+            return
+        self.dashboard.page = int(self.page.value) - 1
+        await self.dashboard.update_message(interaction)
 
 
 class AdminPaymentsView(View):
+    """Grid of many users × 12 months per page.
 
-    def __init__(self, user_ids, current_index, year, invoking_user_id):
-        super().__init__(timeout=60)
-        self.user_ids = user_ids
-        self.current_index = current_index
-        self.year = year
+    Each year's masks are read from the store once and each name resolved
+    once, so page flips, filters and jumps are served from memory.
+    """
+
+    def __init__(self, bot, store, year, invoking_user_id):
+        super().__init__(timeout=300)
+        self.bot = bot
+        self.store = store
+        self.year = str(year)
         self.invoking_user_id = invoking_user_id
+        self.page = 0
+        self.unpaid_only = False
+        self.names = {}
+        # (year, unpaid_only) -> [(user_id, mask)]
+        self._rows = {}
 
-    @discord.ui.button(label="Previous", style=discord.ButtonStyle.gray)
-    async def prev_button(self, interaction: discord.Interaction,
-                          button: discord.Button):
+    async def interaction_check(self, interaction: discord.Interaction):
         if interaction.user.id != self.invoking_user_id:
             await interaction.response.send_message(
                 "Only the user who executed the command can use this button!")
-            return
-        self.current_index = (self.current_index - 1) % len(self.user_ids)
+            return False
+        return True
+
+    async def rows(self):
+        key = (self.year, self.unpaid_only)
+        rows = self._rows.get(key)
+        if rows is None:
+            if self.unpaid_only:
+                due = due_mask(self.year, datetime.date.today())
+                rows = [(user_id, mask)
+                        for user_id, mask in await self.rows_for_year()
+                        if mask & due != due]
+            else:
+                rows = await self.rows_for_year()
+            self._rows[key] = rows
+        return rows
+
+    async def rows_for_year(self):
+        key = (self.year, False)
+        if key not in self._rows:
+            self._rows[key] = await self.store.year_masks(self.year)
+        return self._rows[key]
+
+    async def render(self):
+        """Builds the current page and updates the buttons to match."""
+        if not self.year_select.options:
+            years = await self.store.years() or [self.year]
+            # A select menu holds at most 25 options
+            self.year_select.options = [
+                discord.SelectOption(label=y, default=y == self.year)
+                for y in years[-25:]
+            ]
+        rows = await self.rows()
+        page_count = max(1, -(-len(rows) // PAGE_SIZE))
+        self.page = min(max(self.page, 0), page_count - 1)
+        page_rows = rows[self.page * PAGE_SIZE:(self.page + 1) * PAGE_SIZE]
+        missing = [user_id for user_id, _ in page_rows
+                   if user_id not in self.names]
+        names = await asyncio.gather(*(display_name(self.bot, user_id)
+                                       for user_id in missing))
+        self.names.update(zip(missing, names))
+
+        lines = [f"{'User':<{NAME_WIDTH}} {MONTH_INITIALS}"]
+        for user_id, mask in page_rows:
+            name = str(self.names[user_id]).replace('`', "'")[:NAME_WIDTH]
+            marks = ' '.join('✓' if mask & (1 << bit) else '·'
+                             for bit in range(12))
+            lines.append(f"{name:<{NAME_WIDTH}} {marks}")
+        if not page_rows:
+            lines.append("No users match this filter.")
+        description = "with unpaid months" if self.unpaid_only else "total"
+        self.prev_button.disabled = self.page == 0
+        self.next_button.disabled = self.page >= page_count - 1
+        self.unpaid_button.label = ("Show all"
+                                    if self.unpaid_only else "Unpaid only")
+        return (
+            f"**Payments for {self.year}** (page {self.page + 1}/{page_count}, {len(rows)} user(s) {description})\n"
+            "```\n" + "\n".join(lines) + "\n```")
+
+    async def update_message(self, interaction: discord.Interaction):
+        await interaction.response.edit_message(content=await self.render(),
+                                                view=self)
+
+    @discord.ui.button(label="Previous", style=discord.ButtonStyle.gray)
+    @metrics.instrument("button:admin_previous")
+    async def prev_button(self, interaction: discord.Interaction,
+                          button: discord.Button):
+        self.page -= 1
         await self.update_message(interaction)
 
     @discord.ui.button(label="Next", style=discord.ButtonStyle.gray)
+    @metrics.instrument("button:admin_next")
     async def next_button(self, interaction: discord.Interaction,
                           button: discord.Button):
-        if interaction.user.id != self.invoking_user_id:
-            await interaction.response.send_message(
-                "Only the user who executed the command can use this button!")
-            return
-        self.current_index = (self.current_index + 1) % len(self.user_ids)
+        self.page += 1
+        await self.update_message(interaction)
+
+    @discord.ui.button(label="Go to page", style=discord.ButtonStyle.gray)
+    @metrics.instrument("button:admin_jump")
+    async def jump_button(self, interaction: discord.Interaction,
+                          button: discord.Button):
+        await interaction.response.send_modal(JumpToPageModal(self))
+
+    @discord.ui.button(label="Unpaid only", style=discord.ButtonStyle.blurple)
+    @metrics.instrument("button:admin_unpaid_filter")
+    async def unpaid_button(self, interaction: discord.Interaction,
+                            button: discord.Button):
+        self.unpaid_only = not self.unpaid_only
+        self.page = 0
         await self.update_message(interaction)
 
     @discord.ui.button(label="Close", style=discord.ButtonStyle.red)
+    @metrics.instrument("button:admin_close")
     async def close_button(self, interaction: discord.Interaction,
                            button: discord.Button):
-        if interaction.user.id != self.invoking_user_id:
-            await interaction.response.send_message(
-                "Only the user who executed the command can use this button!")
-            return
         await interaction.message.delete()
 
-    async def update_message(self, interaction: discord.Interaction):
-        if interaction.user.id != self.invoking_user_id:
-            await interaction.response.send_message(
-                "Only the user who executed the command can use this button!")
-            return
-        user_id = self.user_ids[self.current_index]
-        user = await interaction.client.fetch_user(int(user_id))
-        payments = get_user_payments(load_payments(), user_id, self.year)
-        response = f"**Payments for {user.name} ({self.year})**\n"
-        for mes in month_translation.values():
-            status = "✅" if payments.get(mes, False) else "❌"
-            response += f"{mes.capitalize()}: {status}\n"
-        await interaction.response.edit_message(content=response, view=self)
+    @discord.ui.select(placeholder="Year", row=1)
+    @metrics.instrument("select:admin_year")
+    async def year_select(self, interaction: discord.Interaction,
+                          select: discord.ui.Select):
+        self.year = select.values[0]
+        self.page = 0
+        for option in select.options:
+            option.default = option.label == self.year
+        await self.store.load_year(self.year)
+        await self.update_message(interaction)
 
 
 @commands.command()
@@ -66,10 +181,9 @@ async def definir_canal_lembrete(ctx, channel: discord.TextChannel):
     """Sets the reminders channel."""
     if not await check_command_channel(ctx):
         return
-    ctx.bot.lembrete_channel_id = channel.id
-    payments = load_payments()
-    save_payments(payments, ctx.bot.lembrete_channel_id,
-                  ctx.bot.commands_channel_id, ctx.bot.confirmation_channel_id)
+    store = await ctx.bot.stores.get(ctx.guild.id)
+    store.set_setting('lembrete_channel_id', channel.id)
+    await store.save()
     await ctx.send(f"Reminders channel set to {channel.mention}.")
 
 
@@ -79,10 +193,9 @@ async def definir_canal_comandos(ctx, channel: discord.TextChannel):
     """Sets the commands channel."""
     if not await check_command_channel(ctx):
         return
-    ctx.bot.commands_channel_id = channel.id
-    payments = load_payments()
-    save_payments(payments, ctx.bot.lembrete_channel_id,
-                  ctx.bot.commands_channel_id, ctx.bot.confirmation_channel_id)
+    store = await ctx.bot.stores.get(ctx.guild.id)
+    store.set_setting('commands_channel_id', channel.id)
+    await store.save()
     await ctx.send(f"Commands channel set to {channel.mention}.")
 
 
@@ -92,13 +205,44 @@ async def definir_canal_confirmacao(ctx, channel: discord.TextChannel):
     """Sets the payment confirmation channel."""
     if not await check_command_channel(ctx):
         return
-    ctx.bot.confirmation_channel_id = channel.id
-    payments = load_payments()
-    save_payments(payments, ctx.bot.lembrete_channel_id,
-                  ctx.bot.commands_channel_id, ctx.bot.confirmation_channel_id)
+    store = await ctx.bot.stores.get(ctx.guild.id)
+    store.set_setting('confirmation_channel_id', channel.id)
+    await store.save()
     await ctx.send(f"Payment confirmation channel set to {channel.mention}.")
 
 
+@commands.command()
+@commands.has_permissions(administrator=True)
+async def definir_modo_lembrete(ctx, mode: str):
+    """Sets whether reminders go out per user or as digests."""
+    if not await check_command_channel(ctx):
+        return
+    mode = mode.lower()
+    if mode not in ('individual', 'digest'):
+        await ctx.send("Please choose individual or digest.")
+        return
+    store = await ctx.bot.stores.get(ctx.guild.id)
+    store.set_setting('reminder_mode', mode)
+    await store.save()
+    await ctx.send(f"Reminder mode set to {mode}.")
+
+
+@commands.command()
+@commands.has_permissions(administrator=True)
+async def definir_modo_resumo(ctx, mode: str):
+    """Sets whether the monthly summary is sent as text or as a CSV file."""
+    if not await check_command_channel(ctx):
+        return
+    mode = mode.lower()
+    if mode not in SUMMARY_MODES:
+        await ctx.send("Please choose auto, text or csv.")
+        return
+    store = await ctx.bot.stores.get(ctx.guild.id)
+    store.set_setting('summary_mode', mode)
+    await store.save()
+    await ctx.send(f"Summary mode set to {mode}.")
+
+
 @commands.command()
 @commands.has_permissions(administrator=True)
 async def testar_lembrete(ctx):
@@ -111,36 +255,48 @@ async def testar_lembrete(ctx):
     current_month_en = datetime.datetime.now().strftime("%B").lower()
     current_month_pt = month_translation.get(current_month_en,
                                              current_month_en)
-    payments = load_payments()
+    store = await ctx.bot.stores.get(ctx.guild.id)
 
-    if not payments:
+    if not store.user_count():
         await ctx.send("No registered users to test the reminder.")
         return
 
-    sent = 0
-    if ctx.bot.lembrete_channel_id:
-        reminders_channel = ctx.bot.get_channel(ctx.bot.lembrete_channel_id)
+    if store.settings.get('lembrete_channel_id'):
+        reminders_channel = ctx.bot.get_channel(
+            store.settings['lembrete_channel_id'])
     else:
         await ctx.send(
             "Reminders channel not set. Please use !definir_canal_lembrete.")
         return
+    if not reminders_channel:
+        await ctx.send(
+            "Reminders channel not found. Please use !definir_canal_lembrete."
+        )
+        return
 
-    for user_id in payments:
-        if user_id not in ('settings', 'pending_payments'):
-            ensure_user_month(payments, user_id, current_year,
-                              current_month_pt)
-            if not is_month_paid(payments, user_id, current_year,
-                                 current_month_en):
-                user = await ctx.bot.fetch_user(int(user_id))
-                if user:
-                    view = PaymentView(int(user_id), current_year,
-                                       current_month_pt)
-                    message = f"[TEST] {user.mention}, tomorrow is the Spotify payment day for {current_month_pt.capitalize()}/{current_year}. Have you sent the money?"
-                    await reminders_channel.send(message, view=view)
-                    sent += 1
+    unpaid = await store.unpaid_users(current_year, current_month_pt)
+    if store.settings.get('reminder_mode') == 'digest':
+        stats = await send_digest(
+            reminders_channel,
+            unpaid,
+            f"[TEST] Tomorrow is the Spotify payment day for {current_month_pt.capitalize()}/{current_year}. Have you sent the money?\n",
+            make_view=lambda: DigestPaymentView(current_year, current_month_pt
+                                                ))
+        await ctx.send(
+            f"Test digest sent in {stats.sent} message(s) to {len(unpaid)} user(s) with {current_month_pt.capitalize()} unpaid ({stats.failed} failed, {stats.retried} retried)."
+        )
+        return
+    stats = await send_reminders(
+        ctx.bot,
+        unpaid,
+        lambda user:
+        f"[TEST] {user.mention}, tomorrow is the Spotify payment day for {current_month_pt.capitalize()}/{current_year}. Have you sent the money?",
+        make_view=lambda user_id: PaymentView(ctx.guild.id, user_id,
+                                              current_year, current_month_pt),
+        channel=reminders_channel)
 
     await ctx.send(
-        f"Test reminder sent to {sent} user(s) with {current_month_pt.capitalize()} unpaid."
+        f"Test reminder sent to {stats.sent} user(s) with {current_month_pt.capitalize()} unpaid ({stats.failed} failed, {stats.retried} retried)."
     )
 
 
@@ -150,31 +306,13 @@ async def todos_pagamentos(ctx):
     """Shows all users' payments."""
     if not await check_command_channel(ctx):
         return
-    await ctx.send("Loading all users' payments...")
-
-    payments = load_payments()
-    user_ids = [
-        uid for uid in payments.keys()
-        if uid not in ('settings', 'pending_payments')
-    ]
-    if not user_ids:
+    store = await ctx.bot.stores.get(ctx.guild.id)
+    if not store.user_count():
         await ctx.send("No registered users.")
         return
 
     current_year = str(datetime.datetime.now().year)
-
-    async def show_page(index):
-        user_id = user_ids[index]
-        user = await ctx.bot.fetch_user(int(user_id))
-        payments_data = get_user_payments(payments, user_id, current_year)
-        response = f"**Payments for {user.name} ({current_year})**\n"
-        for mes in month_translation.values():
-            status = "✅" if payments_data.get(mes, False) else "❌"
-            response += f"{mes.capitalize()}: {status}\n"
-        view = AdminPaymentsView(user_ids, index, current_year, ctx.author.id)
-        if len(user_ids) == 1:
-            view.prev_button.disabled = True
-            view.next_button.disabled = True
-        await ctx.send(response, view=view)
-
-    await show_page(0)
+    # Fills bot.get_user in bulk, so the pages resolve names from memory
+    await ctx.bot.user_cache.prefetch(ctx.guild)
+    view = AdminPaymentsView(ctx.bot, store, current_year, ctx.author.id)
+    await ctx.send(await view.render(), view=view)
@@ -0,0 +1,180 @@
+import asyncio
+import itertools
+import random
+from types import SimpleNamespace
+
+
+class FakeDiscord:
+    """Local stand-in for the Discord API: users, channels and REST latency.
+
+    Every call that would hit Discord's REST API sleeps for the configured
+    latency (plus jitter) and is counted, so a benchmark can report how many
+    requests a handler makes as well as how long it takes.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.rest_calls = 0
+        self.users = {}
+        self.channels = {}
+        self._ids = itertools.count(10**17)
+
+    def next_id(self):
+        return next(self._ids)
+
+    async def rest(self):
+        self.rest_calls += 1
+        delay = self.latency
+        if self.jitter:
+            delay += self.random.uniform(0, self.jitter)
+        await asyncio.sleep(delay)
+
+    def add_user(self, user_id, administrator=False):
+        user = FakeUser(self, int(user_id), administrator)
+        self.users[user.id] = user
+        return user
+
+    def add_guild(self):
+        return FakeGuild(self.next_id())
+
+    def add_channel(self, guild=None):
+        channel = FakeChannel(self, self.next_id(), guild)
+        self.channels[channel.id] = channel
+        return channel
+
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+    async def fetch_user(self, user_id):
+        await self.rest()
+        user = self.users.get(int(user_id))
+        if user is None:
+            user = self.add_user(user_id)
+        return user
+
+
+class FakeMessage:
+
+    def __init__(self, api, message_id, channel, content=None, view=None):
+        self.api = api
+        self.id = message_id
+        self.channel = channel
+        self.content = content
+        self.view = view
+
+    async def edit(self, content=None, view=None, **kwargs):
+        await self.api.rest()
+        self.content = content
+        self.view = view
+        return self
+
+    async def delete(self):
+        await self.api.rest()
+
+
+class FakeGuild:
+    """A guild whose members are already chunked."""
+
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.chunked = True
+
+    async def chunk(self):
+        pass
+
+
+class FakeChannel:
+
+    def __init__(self, api, channel_id, guild=None):
+        self.api = api
+        self.id = channel_id
+        self.guild = guild
+        self.mention = f"<#{channel_id}>"
+        self.sent = 0
+
+    async def send(self, content=None, view=None, **kwargs):
+        await self.api.rest()
+        self.sent += 1
+        return FakeMessage(self.api, self.api.next_id(), self,
+                           content, view)
+
+    def get_partial_message(self, message_id):
+        return FakeMessage(self.api, message_id, self)
+
+
+class FakeUser(FakeChannel):
+    """A user is a DM channel too: send() goes straight to the fake API."""
+
+    def __init__(self, api, user_id, administrator=False):
+        super().__init__(api, user_id)
+        self.name = f"user{user_id}"
+        self.mention = f"<@{user_id}>"
+        self.bot = False
+        self.guild_permissions = SimpleNamespace(administrator=administrator)
+
+
+class FakeResponse:
+
+    def __init__(self, api):
+        self.api = api
+        self.done = False
+
+    async def send_message(self, content=None, **kwargs):
+        await self.api.rest()
+        self.done = True
+
+    async def edit_message(self, content=None, **kwargs):
+        await self.api.rest()
+        self.done = True
+
+
+class FakeInteraction:
+    """What a button callback reads from a discord.Interaction."""
+
+    def __init__(self, api, client, user, message):
+        self.client = client
+        self.user = user
+        self.message = message
+        guild = message.channel.guild
+        self.guild_id = guild.id if guild else None
+        self.response = FakeResponse(api)
+
+
+class FakeContext:
+    """What a command callback reads from a commands.Context."""
+
+    def __init__(self, bot, author, channel, command):
+        self.bot = bot
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild
+        self.command = command
+        self.message = SimpleNamespace(author=author, channel=channel)
+
+    async def send(self, content=None, **kwargs):
+        return await self.channel.send(content, **kwargs)
+
+
+def fake_message(author, channel, content=''):
+    """A gateway message, as on_message receives it."""
+    return SimpleNamespace(author=author,
+                           channel=channel,
+                           guild=channel.guild,
+                           content=content)
+
+
+def attach(bot, api, member_cache=False):
+    """Points a commands.Bot at the fake API instead of a gateway session.
+
+    With member_cache the users resolve from bot.get_user, as they do once
+    the guilds are chunked; otherwise every first lookup goes through
+    fetch_user.
+    """
+    bot.get_channel = api.get_channel
+    bot.fetch_user = api.fetch_user
+    if member_cache:
+        bot.get_user = api.users.get
+    else:
+        bot.get_user = lambda user_id: None
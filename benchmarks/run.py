@@ -0,0 +1,437 @@
+"""Offline benchmarks for the storage and fan-out paths.
+
+Drives the real handlers (on_message, !pagar, the Confirm button,
+check_payments, monthly_summary and !todos_pagamentos) against a local
+stand-in for the Discord API, on synthetic payment stores, and reports
+throughput, p50/p99 latency, memory and REST calls per scenario.
+
+Run from the repository root:
+
+    python -m benchmarks.run --users 10 1000 100000 --latency 0.02
+    PAYMENTS_BACKEND=sqlite python -m benchmarks.run --json results.json
+"""
+import argparse
+import asyncio
+import contextlib
+import datetime
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+import admin
+import bot as bot_module
+import user
+from benchmarks.fake_discord import (FakeDiscord, FakeContext,
+                                     FakeInteraction, attach, fake_message)
+from rendercache import RenderCache
+from store import GuildStores
+from usercache import UserCache
+from utils import PAYMENTS_FILE, month_translation, save_payments
+from views import ConfirmPaymentButton
+
+# Synthetic user ids start here, like real snowflakes
+USER_ID_BASE = 3 * 10**17
+# The benchmark runs in June: reminders on the 13th, the summary on July 1st
+BENCH_MONTH = 6
+MONTHS = list(month_translation.values())
+# Modules whose datetime.now() follows the benchmark clock
+CLOCK_MODULES = (bot_module, user, admin)
+
+
+class FrozenDatetime(datetime.datetime):
+    moment = None
+
+    @classmethod
+    def now(cls, tz=None):
+        if tz is None:
+            return cls.moment
+        return cls.moment.astimezone(tz)
+
+
+@contextlib.contextmanager
+def frozen_clock(moment):
+    """Makes datetime.datetime.now() return moment in the bot's modules."""
+    shim = SimpleNamespace(**vars(datetime))
+    shim.datetime = FrozenDatetime
+    FrozenDatetime.moment = moment
+    saved = [(module, module.datetime) for module in CLOCK_MODULES]
+    for module, _ in saved:
+        module.datetime = shim
+    try:
+        yield
+    finally:
+        for module, original in saved:
+            module.datetime = original
+
+
+def synthetic_payments(user_count, year_count, year, seed):
+    """Builds payments.json data: users joined in random years, 80% paid."""
+    rng = random.Random(seed)
+    years = [str(y) for y in range(year - year_count + 1, year + 1)]
+    payments = {'settings': {}, 'pending_payments': {}}
+    for index in range(user_count):
+        first_year = rng.randrange(len(years))
+        records = {}
+        for y in years[first_year:]:
+            # Months after the benchmark month haven't been due yet
+            due = 12 if int(y) < year else BENCH_MONTH
+            records[y] = sum(1 << bit for bit in range(due)
+                             if rng.random() < 0.8)
+        payments[str(USER_ID_BASE + index)] = records
+    return payments
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class Result:
+    """Timings of one scenario."""
+
+    def __init__(self, name, users):
+        self.name = name
+        self.users = users
+        self.latencies = []
+        self.items = 0
+        self.elapsed = 0.0
+        self.memory = 0
+        self.rest_calls = 0
+
+    def as_dict(self):
+        return {
+            'scenario': self.name,
+            'users': self.users,
+            'ops': len(self.latencies),
+            'items': self.items,
+            'seconds': self.elapsed,
+            'throughput': self.items / self.elapsed if self.elapsed else 0.0,
+            'p50_ms': percentile(self.latencies, 0.50) * 1000,
+            'p99_ms': percentile(self.latencies, 0.99) * 1000,
+            'memory_mb': self.memory / 2**20,
+            'rest_calls': self.rest_calls,
+        }
+
+
+class Bench:
+    """One synthetic guild wired to the real bot object."""
+
+    def __init__(self, args, users):
+        self.args = args
+        self.users = users
+        self.api = FakeDiscord(args.latency, args.jitter, args.seed)
+        self.bot = bot_module.bot
+        self.year = datetime.date.today().year
+        self.month = MONTHS[BENCH_MONTH - 1]
+        self.admin = self.api.add_user(USER_ID_BASE - 1, administrator=True)
+        self.guild = self.api.add_guild()
+        self.reminders_channel = self.api.add_channel(self.guild)
+        self.commands_channel = self.api.add_channel(self.guild)
+        self.confirmation_channel = self.api.add_channel(self.guild)
+        self.store = None
+        self.payers = []
+        self.results = []
+
+    async def setup(self):
+        payments = synthetic_payments(self.users, self.args.years, self.year,
+                                      self.args.seed)
+        self.bot.stores = GuildStores()
+        directory = self.bot.stores.directory(self.guild.id)
+        os.makedirs(directory)
+        save_payments(payments, self.reminders_channel.id,
+                      self.commands_channel.id, self.confirmation_channel.id,
+                      os.path.join(directory, PAYMENTS_FILE))
+        del payments
+        attach(self.bot, self.api, self.args.member_cache)
+        # Commands are driven through their callbacks, not message parsing
+        self.bot.process_commands = self._ignore_commands
+        self.bot.user_cache = UserCache(self.bot)
+        self.bot.render_cache = RenderCache()
+        self.bot.stores.migrate_legacy(self.bot)
+        # The first open converts payments.json (into year partitions or
+        # the SQLite database); 'load' times a restart on converted data
+        store = await self.bot.stores.get(self.guild.id)
+        # Waits for the conversion's snapshots before the reopen
+        await store.writer.close()
+        if getattr(store, 'db', None) is not None:
+            store.db.close()
+        del store
+        self.bot.stores = GuildStores()
+        self.bot.stores.migrate_legacy(self.bot)
+
+        baseline = tracemalloc.get_traced_memory()[0]
+        result = self._start('load')
+        started = time.perf_counter()
+        self.store = await self.bot.stores.get(self.guild.id)
+        self._finish(result, [time.perf_counter() - started], self.users,
+                     started)
+        # What the loaded store keeps, rather than the load's peak
+        result.memory = tracemalloc.get_traced_memory()[0] - baseline
+
+    async def teardown(self):
+        await self.store.save()
+        await self.store.writer.close()
+        if getattr(self.store, 'db', None) is not None:
+            self.store.db.close()
+
+    @staticmethod
+    async def _ignore_commands(message):
+        pass
+
+    def _start(self, name):
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        result = Result(name, self.users)
+        result.memory = tracemalloc.get_traced_memory()[0]
+        result.rest_calls = self.api.rest_calls
+        self.results.append(result)
+        return result
+
+    def _finish(self, result, latencies, items, started):
+        result.elapsed = time.perf_counter() - started
+        result.latencies = latencies
+        result.items = items
+        result.rest_calls = self.api.rest_calls - result.rest_calls
+        result.memory = tracemalloc.get_traced_memory()[1] - result.memory
+
+    async def measure(self, name, operations, items=None, concurrency=None):
+        """Runs each operation (a coroutine function), bounded, and times it."""
+        result = self._start(name)
+        semaphore = asyncio.Semaphore(concurrency or self.args.concurrency)
+        latencies = []
+
+        async def timed(operation):
+            async with semaphore:
+                started = time.perf_counter()
+                await operation()
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(timed(operation) for operation in operations))
+        self._finish(result, latencies,
+                     len(operations) if items is None else items, started)
+        return result
+
+    def user(self, user_id):
+        return self.api.users.get(int(user_id)) or self.api.add_user(user_id)
+
+    def date(self, month, day):
+        return datetime.datetime(self.year, month, day, 9)
+
+    async def run(self):
+        await self.setup()
+        with frozen_clock(self.date(BENCH_MONTH, 10)):
+            await self.on_message()
+            await self.pagar()
+            await self.confirm()
+            await self.pagamentos()
+            await self.todos_pagamentos()
+            await self.dashboard_pages()
+        await self.check_payments('individual')
+        await self.check_payments('digest')
+        await self.monthly_summary('text')
+        await self.monthly_summary('csv')
+        await self.teardown()
+        return self.results
+
+    async def on_message(self):
+        """Half the messages come from known users, half from new ones."""
+        ops = self.args.ops
+        known = [
+            self.user(USER_ID_BASE + index % self.users)
+            for index in range(ops // 2)
+        ]
+        new = [
+            self.user(USER_ID_BASE + self.users + index)
+            for index in range(ops - len(known))
+        ]
+
+        def operation(author):
+            message = fake_message(author, self.commands_channel, 'hi')
+            return lambda: bot_module.on_message(message)
+
+        await self.measure('on_message',
+                           [operation(author) for author in known + new])
+
+    async def pagar(self):
+        """Up to half the users with the month unpaid run !pagar for it.
+
+        The other half is left for the reminder jobs.
+        """
+        unpaid = await self.store.unpaid_users(self.year, self.month)
+        rng = random.Random(self.args.seed)
+        self.payers = rng.sample(unpaid, min(self.args.ops, len(unpaid) // 2))
+
+        def operation(user_id):
+            ctx = FakeContext(self.bot, self.user(user_id),
+                              self.commands_channel, user.pagar)
+            return lambda: user.pagar.callback(ctx, months=self.month)
+
+        await self.measure('pagar',
+                           [operation(user_id) for user_id in self.payers])
+
+    async def confirm(self):
+        """An admin confirms every payment registered by pagar()."""
+
+        def operation(user_id):
+            pending = self.store.get_pending(user_id, self.year,
+                                                 self.month)
+            message = self.confirmation_channel.get_partial_message(
+                pending['confirmation_message_id'])
+            interaction = FakeInteraction(self.api, self.bot, self.admin,
+                                          message)
+            button = ConfirmPaymentButton('ok', user_id, self.year,
+                                          [self.month])
+            return lambda: button.callback(interaction)
+
+        await self.measure('confirm',
+                           [operation(user_id) for user_id in self.payers])
+
+    async def pagamentos(self):
+        """!pagamentos from a few users, repeatedly."""
+        rng = random.Random(self.args.seed)
+        users = [
+            self.user(USER_ID_BASE + rng.randrange(self.users))
+            for _ in range(10)
+        ]
+
+        def operation(author):
+            ctx = FakeContext(self.bot, author, self.commands_channel,
+                              user.pagamentos)
+            return lambda: user.pagamentos.callback(ctx)
+
+        await self.measure('pagamentos', [
+            operation(users[index % len(users)])
+            for index in range(self.args.ops)
+        ])
+
+    async def todos_pagamentos(self):
+        ctx = FakeContext(self.bot, self.admin, self.commands_channel,
+                          admin.todos_pagamentos)
+        await self.measure(
+            'todos_pagamentos',
+            [lambda: admin.todos_pagamentos.callback(ctx)] * self.args.repeat,
+            concurrency=1)
+
+    async def dashboard_pages(self):
+        """Flips through the !todos_pagamentos grid, then filters it."""
+        view = admin.AdminPaymentsView(self.bot, self.store, self.year,
+                                       self.admin.id)
+        await view.render()
+        message = self.commands_channel.get_partial_message(
+            self.api.next_id())
+
+        def operation(button):
+            interaction = FakeInteraction(self.api, self.bot, self.admin,
+                                          message)
+            return lambda: button.callback(interaction)
+
+        flips = [operation(view.next_button)] * self.args.ops
+        flips.append(operation(view.unpaid_button))
+        await self.measure('dashboard_pages', flips, concurrency=1)
+
+    async def check_payments(self, mode):
+        """The 13th's reminders, as check_payments sends them per guild."""
+        self.store.set_setting('reminder_mode', mode)
+        unpaid = len(await self.store.unpaid_users(self.year, self.month))
+        now = self.date(BENCH_MONTH, 13)
+        await self.measure(
+            f'check_payments[{mode}]',
+            [lambda: bot_module.remind_guild(self.guild, self.store, now)] *
+            self.args.repeat,
+            items=unpaid * self.args.repeat,
+            concurrency=1)
+
+    async def monthly_summary(self, mode):
+        self.store.set_setting('summary_mode', mode)
+        now = self.date(BENCH_MONTH + 1, 1)
+        await self.measure(
+            f'monthly_summary[{mode}]',
+            [lambda: bot_module.summarize_guild(self.guild, self.store, now)] *
+            self.args.repeat,
+            items=self.store.user_count() * self.args.repeat,
+            concurrency=1)
+
+
+def print_table(rows):
+    columns = ('scenario', 'users', 'ops', 'throughput', 'p50_ms', 'p99_ms',
+               'memory_mb', 'rest_calls')
+    print(f"{columns[0]:<28}" + ''.join(f"{column:>12}"
+                                        for column in columns[1:]))
+    for row in rows:
+        print(f"{row['scenario']:<28}" + ''.join(
+            f"{row[column]:>12.2f}" if isinstance(row[column], float) else
+            f"{row[column]:>12}" for column in columns[1:]))
+
+
+async def main(args):
+    rows = []
+    workdir = os.getcwd()
+    for users in args.users:
+        with tempfile.TemporaryDirectory() as directory:
+            # payments.json, the journal and payments.db live in the cwd
+            os.chdir(directory)
+            try:
+                results = await Bench(args, users).run()
+            finally:
+                os.chdir(workdir)
+        rows.extend(result.as_dict() for result in results)
+    return rows
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users',
+                        type=int,
+                        nargs='+',
+                        default=[10, 1000, 10000, 100000],
+                        help="store sizes to benchmark")
+    parser.add_argument('--years',
+                        type=int,
+                        default=10,
+                        help="years of history per store")
+    parser.add_argument('--ops',
+                        type=int,
+                        default=200,
+                        help="events per on_message/pagar/confirm scenario")
+    parser.add_argument('--repeat',
+                        type=int,
+                        default=3,
+                        help="runs of each scheduled job and !todos_pagamentos")
+    parser.add_argument('--concurrency',
+                        type=int,
+                        default=20,
+                        help="events handled at once")
+    parser.add_argument('--latency',
+                        type=float,
+                        default=0.0,
+                        help="seconds per fake REST call")
+    parser.add_argument('--jitter',
+                        type=float,
+                        default=0.0,
+                        help="random extra seconds per fake REST call")
+    parser.add_argument('--member-cache',
+                        action='store_true',
+                        help="resolve users from bot.get_user (chunked guild)")
+    parser.add_argument('--no-memory',
+                        action='store_true',
+                        help="skip tracemalloc, which slows every scenario")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help="also write the results to this file")
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    if not args.no_memory:
+        tracemalloc.start()
+    rows = asyncio.run(main(args))
+    print_table(rows)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(rows, f, indent=2)
@@ -1,10 +1,23 @@
+import asyncio
+import os
+import time
 import discord
 from discord.ext import commands, tasks
 import datetime
-from utils import load_payments, save_payments, ensure_user_month, month_translation, reset_payments, is_month_paid
-from admin import AdminPaymentsView, definir_canal_lembrete, definir_canal_comandos, definir_canal_confirmacao, testar_lembrete, todos_pagamentos
-from user import PaymentView, UserPaymentsView, pagar, pagamentos, ajuda
-from views import ConfirmPaymentView
+from utils import month_translation
+from admin import AdminPaymentsView, definir_canal_lembrete, definir_canal_comandos, definir_canal_confirmacao, definir_modo_lembrete, definir_modo_resumo, testar_lembrete, todos_pagamentos
+from user import PaymentView, PaymentButton, UserPaymentsView, DigestPaymentButton, DigestPaymentView, pagar, pagamentos, definir_horario, ajuda
+from views import ConfirmPaymentView, ConfirmPaymentButton
+from store import GuildStores
+from usercache import UserCache
+from rendercache import RenderCache
+from webserver import start_webserver
+import metrics
+from reminders import send_reminders, send_digest
+from summary import send_summary
+from pending import expire_pending, reconcile_pending
+from scheduler import TIMEZONE, MonthlyJob, Scheduler, claim
+from timingwheel import TimingWheel, send_time
 
 # Bot configuration
 intents = discord.Intents.default()
@@ -12,26 +25,60 @@ intents.members = True
 intents.message_content = True
 intents.messages = True
 
-bot = commands.Bot(command_prefix='!', intents=intents)
-bot.lembrete_channel_id = None
-bot.commands_channel_id = None
-bot.confirmation_channel_id = None
+# One process serves every guild; discord.py picks the shard count
+bot = commands.AutoShardedBot(command_prefix='!', intents=intents)
+bot.stores = GuildStores()
+bot.user_cache = UserCache(bot)
+bot.render_cache = RenderCache()
+bot.scheduler = Scheduler(os.path.join(bot.stores.root, 'schedule.json'))
+bot.scheduler_task = None
+# Individual reminders wait here for each user's hour
+bot.reminder_wheel = TimingWheel()
+bot.reminders_queued = asyncio.Event()
+
+
+@bot.event
+async def setup_hook():
+    """Starts the health server and loop monitor once, before connecting."""
+    metrics.instrument_http(bot.http)
+    bot.webserver = await start_webserver(bot)
+    bot.loop_monitor = asyncio.create_task(metrics.monitor_loop_lag())
+    bot.metrics_logger = asyncio.create_task(metrics.log_periodically())
+
+
+@bot.before_invoke
+async def start_command_metrics(ctx):
+    """Attributes the command's REST calls and starts its timer."""
+    ctx.metrics_state = metrics.start_handler(f"command:{ctx.command.name}")
+
+
+@bot.after_invoke
+async def stop_command_metrics(ctx):
+    metrics.finish_handler(ctx.metrics_state)
 
 
 @bot.event
 async def on_ready():
     """Called when the bot is ready."""
-    print(f"Bot online as {bot.user}")
-    payments = load_payments()
-    bot.lembrete_channel_id = payments.get('settings',
-                                           {}).get('lembrete_channel_id')
-    bot.commands_channel_id = payments.get('settings',
-                                           {}).get('commands_channel_id')
-    bot.confirmation_channel_id = payments.get(
-        'settings', {}).get('confirmation_channel_id')
-    check_payments.start()
-    check_late_payments.start()
-    monthly_summary.start()
+    print(f"Bot online as {bot.user} in {len(bot.guilds)} guild(s)")
+    bot.stores.migrate_legacy(bot)
+    if not sweep_pending.is_running():
+        sweep_pending.start()
+    if bot.scheduler_task is None:
+        # Before the scheduler, so a caught-up run isn't queued twice
+        await requeue_reminders()
+        bot.delivery_task = asyncio.create_task(deliver_reminders())
+        bot.scheduler_task = asyncio.create_task(bot.scheduler.run())
+    if not getattr(bot, 'pending_reconciled', False):
+        # Once per process: reconnects don't lose confirmation messages
+        bot.pending_reconciled = True
+        await for_each_guild(reconcile_guild_pending, existing=True)
+
+
+@bot.check
+async def guild_only(ctx):
+    """Commands act on one guild's payments, so they can't run in DMs."""
+    return ctx.guild is not None
 
 
 @bot.event
@@ -39,113 +86,323 @@ async def on_message(message):
     """Tracks messages to register users."""
     if message.author.bot:
         return
-    try:
-        current_year = str(datetime.datetime.now().year)
-        current_month_en = datetime.datetime.now().strftime("%B").lower()
-        current_month = month_translation.get(current_month_en,
-                                              current_month_en)
-        payments = load_payments()
-        ensure_user_month(payments, message.author.id, current_year,
-                          current_month)
-        save_payments(payments, bot.lembrete_channel_id,
-                      bot.commands_channel_id, bot.confirmation_channel_id)
-    except Exception as e:
-        print(f"Error processing message: {e}")
+    if message.guild is not None:
+        try:
+            current_year = str(datetime.datetime.now().year)
+            current_month_en = datetime.datetime.now().strftime("%B").lower()
+            current_month = month_translation.get(current_month_en,
+                                                  current_month_en)
+            store = await bot.stores.get(message.guild.id)
+            if store.ensure_user_month(message.author.id, current_year,
+                                       current_month):
+                store.schedule_save()
+        except Exception as e:
+            print(f"Error processing message: {e}")
     await bot.process_commands(message)
 
 
-@tasks.loop(time=datetime.time(
-    hour=0, minute=0, tzinfo=datetime.timezone(datetime.timedelta(hours=1))))
-async def check_payments():
-    """Sends reminders on the 13th of each month."""
-    now = datetime.datetime.now()
-    if now.day != 13:
+async def for_each_guild(job, *args, existing=False):
+    """Runs job(guild, store, *args) for every guild at once.
+
+    Guilds don't wait on each other, and one guild's failure doesn't stop
+    the others. With existing, guilds that never had a store are skipped
+    instead of getting an empty one created and loaded.
+    """
+
+    async def run(guild):
+        try:
+            store = await bot.stores.get(guild.id)
+            await job(guild, store, *args)
+        except Exception as e:
+            print(f"{job.__name__} failed for guild {guild.id}: {e}")
+
+    guilds = bot.guilds
+    if existing:
+        guilds = [guild for guild in guilds if bot.stores.exists(guild.id)]
+    await asyncio.gather(*(run(guild) for guild in guilds))
+
+
+def reminders_channel(store):
+    """Returns the guild's reminders channel, None for DMs or False if gone."""
+    channel_id = store.settings.get('lembrete_channel_id')
+    if not channel_id:
+        return None
+    return bot.get_channel(channel_id) or False
+
+
+async def run_claimed(guild, store, name, job, scheduled):
+    """Runs a scheduled job for the guild, unless it already ran.
+
+    The first run in a new year also closes the previous one, whatever
+    the job ends up sending.
+    """
+    if not claim(store, name, scheduled):
         return
+    store.rollover(scheduled.year)
+    await store.save()
+    try:
+        await job(guild, store, scheduled)
+    except Exception as e:
+        print(f"{job.__name__} failed for guild {guild.id}: {e}")
+
+
+def monthly_job(name, job):
+    """Runs job(guild, store, scheduled) once per guild and period."""
+
+    async def run(scheduled):
+        with metrics.timed_job(name):
+            await for_each_guild(run_claimed,
+                                 name,
+                                 job,
+                                 scheduled,
+                                 existing=True)
+
+    return run
+
+
+async def remind_guild(guild, store, now, user_ids=None):
+    """Reminds one guild's users (or those of user_ids) who haven't paid."""
     current_year = str(now.year)
     current_month_en = now.strftime("%B").lower()
     current_month = month_translation.get(current_month_en, current_month_en)
 
-    payments = load_payments()
-    if now.month == 1:
-        reset_payments(payments)
-        save_payments(payments, bot.lembrete_channel_id,
-                      bot.commands_channel_id, bot.confirmation_channel_id)
-
-    for user_id in payments:
-        if user_id not in ('settings', 'pending_payments'):
-            ensure_user_month(payments, user_id, current_year, current_month)
-            if not is_month_paid(payments, user_id, current_year,
-                                 current_month_en):
-                user = await bot.fetch_user(int(user_id))
-                if user:
-                    view = PaymentView(int(user_id), current_year,
-                                       current_month)
-                    message = f"{user.mention}, tomorrow is the Spotify payment day for {current_month.capitalize()}/{current_year}. Have you sent the money?"
-                    if bot.lembrete_channel_id:
-                        reminders_channel = bot.get_channel(
-                            bot.lembrete_channel_id)
-                        if reminders_channel:
-                            await reminders_channel.send(message, view=view)
-                    else:
-                        await user.send(message, view=view)
-
-
-@tasks.loop(time=datetime.time(
-    hour=0, minute=0, tzinfo=datetime.timezone(datetime.timedelta(hours=1))))
-async def check_late_payments():
-    """Notifies late payments on the 15th."""
-    now = datetime.datetime.now()
-    if now.day != 15:
+    channel = reminders_channel(store)
+    if channel is False:
         return
+    unpaid = await store.unpaid_users(current_year, current_month)
+    if user_ids is not None:
+        unpaid = [user_id for user_id in unpaid if user_id in user_ids]
+    await bot.user_cache.prefetch(guild)
+    if channel and store.settings.get('reminder_mode') == 'digest':
+        stats = await send_digest(
+            channel,
+            unpaid,
+            f"Tomorrow is the Spotify payment day for {current_month.capitalize()}/{current_year}. Have you sent the money?\n",
+            make_view=lambda: DigestPaymentView(current_year, current_month))
+        print(
+            f"Reminder digest for {current_month}/{current_year} in guild {guild.id}: {stats}"
+        )
+        return
+    stats = await send_reminders(
+        bot,
+        unpaid,
+        lambda user:
+        f"{user.mention}, tomorrow is the Spotify payment day for {current_month.capitalize()}/{current_year}. Have you sent the money?",
+        make_view=lambda user_id: PaymentView(guild.id, user_id,
+                                              current_year, current_month),
+        channel=channel)
+    print(
+        f"Reminders for {current_month}/{current_year} in guild {guild.id}: {stats}"
+    )
+
+
+async def notify_late_guild(guild, store, now, user_ids=None):
+    """Tells one guild's users (or those of user_ids) they're overdue."""
     current_year = str(now.year)
     current_month_en = now.strftime("%B").lower()
     current_month = month_translation.get(current_month_en, current_month_en)
-    payments = load_payments()
-    for user_id in payments:
-        if user_id not in ('settings', 'pending_payments'):
-            if not is_month_paid(payments, user_id, current_year,
-                                 current_month_en):
-                user = await bot.fetch_user(int(user_id))
-                if user:
-                    message = f"{user.mention}, the Spotify payment for {current_month.capitalize()}/{current_year} is overdue! Please send the money ASAP."
-                    if bot.lembrete_channel_id:
-                        channel = bot.get_channel(bot.lembrete_channel_id)
-                        if channel:
-                            await channel.send(message)
-                    else:
-                        await user.send(message)
-
-
-@tasks.loop(time=datetime.time(hour=0, minute=0, tzinfo=datetime.timezone.utc))
-async def monthly_summary():
-    """Sends a monthly summary on the 1st."""
-    now = datetime.datetime.now()
-    if now.day != 1:
+    channel = reminders_channel(store)
+    if channel is False:
         return
-    current_year = str(now.year)
+    unpaid = await store.unpaid_users(current_year, current_month)
+    if user_ids is not None:
+        unpaid = [user_id for user_id in unpaid if user_id in user_ids]
+    await bot.user_cache.prefetch(guild)
+    if channel and store.settings.get('reminder_mode') == 'digest':
+        stats = await send_digest(
+            channel, unpaid,
+            f"The Spotify payment for {current_month.capitalize()}/{current_year} is overdue! Please send the money ASAP.\n"
+        )
+        print(
+            f"Late payment digest for {current_month}/{current_year} in guild {guild.id}: {stats}"
+        )
+        return
+    stats = await send_reminders(
+        bot,
+        unpaid,
+        lambda user:
+        f"{user.mention}, the Spotify payment for {current_month.capitalize()}/{current_year} is overdue! Please send the money ASAP.",
+        channel=channel)
+    print(
+        f"Late payment notices for {current_month}/{current_year} in guild {guild.id}: {stats}"
+    )
+
+
+async def summarize_guild(guild, store, now):
+    """Posts last month's summary in the guild's reminders channel."""
     last_month_date = now.replace(day=1) - datetime.timedelta(days=1)
+    # December's summary goes out in January, for the previous year
+    year = str(last_month_date.year)
     last_month_en = last_month_date.strftime("%B").lower()
     last_month = month_translation.get(last_month_en, last_month_en)
-    payments = load_payments()
-    response = f"**Payment Summary for {last_month.capitalize()}/{current_year}**\n"
-    for user_id in payments:
-        if user_id not in ('settings', 'pending_payments'):
-            user = await bot.fetch_user(int(user_id))
-            status = "✅" if is_month_paid(payments, user_id, current_year,
-                                          last_month_en) else "❌"
-            response += f"{user.name}: {status}\n"
-    if bot.lembrete_channel_id:
-        channel = bot.get_channel(bot.lembrete_channel_id)
-        if channel:
-            await channel.send(response)
+    channel = reminders_channel(store)
+    if not channel:
+        return
+    await bot.user_cache.prefetch(guild)
+    sent = await send_summary(bot, store, channel, year, last_month,
+                              store.settings.get('summary_mode', 'auto'))
+    print(
+        f"Summary for {last_month}/{year} in guild {guild.id}: {sent} message(s)"
+    )
+
+
+# Scheduled jobs whose individual messages are spread over the day
+STAGGERED_JOBS = {
+    'check_payments': remind_guild,
+    'check_late_payments': notify_late_guild,
+}
+# How long after its fire time a run may still have reminders queued
+STAGGER_WINDOW = datetime.timedelta(days=2)
+
+
+def staggered(name):
+    """Queues the run's individual reminders at each user's hour.
+
+    Digests are few messages per guild, so they still go out at once.
+    """
+
+    async def stagger_guild(guild, store, scheduled):
+        if store.settings.get('reminder_mode') == 'digest':
+            await STAGGERED_JOBS[name](guild, store, scheduled)
+            return
+        await queue_reminders(guild, store, name, scheduled)
+
+    return stagger_guild
+
+
+async def queue_reminders(guild, store, name, scheduled):
+    """Puts the guild's unpaid users on the wheel, past the last bucket sent."""
+    current_month_en = scheduled.strftime("%B").lower()
+    current_month = month_translation.get(current_month_en, current_month_en)
+    sent_through = store.settings.get(f'last_bucket_{name}', 0)
+    queued = 0
+    for user_id in await store.unpaid_users(scheduled.year, current_month):
+        when = send_time(store.get_preference(user_id), scheduled,
+                         user_id).timestamp()
+        if bot.reminder_wheel.bucket_start(when) <= sent_through:
+            continue
+        bot.reminder_wheel.add(
+            when, (guild.id, name, int(scheduled.timestamp()), user_id))
+        queued += 1
+    if queued:
+        bot.reminders_queued.set()
+    print(f"Queued {queued} {name} reminder(s) in guild {guild.id}")
+
+
+async def requeue_reminders():
+    """Queues again the reminders a restart took off the wheel."""
+    now = datetime.datetime.now(datetime.timezone.utc)
+    for job in bot.scheduler.jobs:
+        scheduled = job.previous_fire(now)
+        if job.name in STAGGERED_JOBS and now - scheduled <= STAGGER_WINDOW:
+            await for_each_guild(requeue_guild,
+                                 job.name,
+                                 scheduled,
+                                 existing=True)
+
+
+async def requeue_guild(guild, store, name, scheduled):
+    # Runs the scheduler hasn't claimed yet are queued when it does
+    if store.settings.get(f'last_run_{name}', 0) < scheduled.timestamp():
+        return
+    if store.settings.get('reminder_mode') != 'digest':
+        await queue_reminders(guild, store, name, scheduled)
+
+
+async def deliver_reminders():
+    """Sends each bucket of the wheel once it comes due."""
+    while True:
+        buckets = bot.reminder_wheel.due(time.time())
+        for bucket_start, items in buckets:
+            runs = {}
+            for guild_id, name, scheduled, user_id in items:
+                runs.setdefault((guild_id, name, scheduled),
+                                set()).add(user_id)
+            await asyncio.gather(*(deliver_bucket(*run, user_ids, bucket_start)
+                                   for run, user_ids in runs.items()))
+        now = time.time()
+        try:
+            await asyncio.wait_for(bot.reminders_queued.wait(),
+                                   bot.reminder_wheel.next_bucket(now) - now)
+        except asyncio.TimeoutError:
+            pass
+        bot.reminders_queued.clear()
+
+
+async def deliver_bucket(guild_id, name, scheduled, user_ids, bucket_start):
+    """Sends one guild's bucket with the scheduled job's own lookups."""
+    guild = bot.get_guild(guild_id)
+    if guild is None:
+        return
+    try:
+        store = await bot.stores.get(guild_id)
+        # Recorded first: a restart resends nothing from this bucket
+        store.set_setting(f'last_bucket_{name}', bucket_start)
+        await store.save()
+        with metrics.timed_job(f'{name}_bucket'):
+            await STAGGERED_JOBS[name](
+                guild, store,
+                datetime.datetime.fromtimestamp(scheduled, TIMEZONE),
+                user_ids)
+    except Exception as e:
+        print(f"{name} bucket failed for guild {guild_id}: {e}")
 
 
+@tasks.loop(hours=1)
+async def sweep_pending():
+    """Expires payment confirmations nobody answered in time."""
+    with metrics.timed_job('sweep_pending'):
+        await for_each_guild(expire_guild_pending, existing=True)
+
+
+async def expire_guild_pending(guild, store):
+    expired = await expire_pending(
+        store, bot.get_channel(store.settings.get('confirmation_channel_id')),
+        bot.get_channel(store.settings.get('commands_channel_id')))
+    if expired:
+        print(f"Expired {expired} pending confirmation(s) in guild {guild.id}")
+
+
+async def reconcile_guild_pending(guild, store):
+    """Drops confirmations whose message was deleted while offline."""
+    dropped = await reconcile_pending(
+        store, bot.get_channel(store.settings.get('confirmation_channel_id')))
+    if dropped:
+        print(f"Dropped {dropped} stale confirmation(s) in guild {guild.id}")
+
+
+# Calendar jobs: reminders on the 13th and late notices on the 15th at
+# midnight (UTC+1), last month's summary on the 1st at midnight UTC
+bot.scheduler.add(
+    MonthlyJob('check_payments', 13, datetime.time(hour=0, tzinfo=TIMEZONE),
+               monthly_job('check_payments', staggered('check_payments')),
+               catch_up=datetime.timedelta(days=1)))
+bot.scheduler.add(
+    MonthlyJob('check_late_payments', 15,
+               datetime.time(hour=0, tzinfo=TIMEZONE),
+               monthly_job('check_late_payments',
+                           staggered('check_late_payments')),
+               catch_up=datetime.timedelta(days=3)))
+bot.scheduler.add(
+    MonthlyJob('monthly_summary', 1,
+               datetime.time(hour=0, tzinfo=datetime.timezone.utc),
+               monthly_job('monthly_summary', summarize_guild),
+               catch_up=datetime.timedelta(days=7)))
+
 # Register commands
 bot.add_command(definir_canal_lembrete)
 bot.add_command(definir_canal_comandos)
 bot.add_command(definir_canal_confirmacao)
+bot.add_command(definir_modo_lembrete)
+bot.add_command(definir_modo_resumo)
 bot.add_command(testar_lembrete)
 bot.add_command(todos_pagamentos)
 bot.add_command(pagar)
 bot.add_command(pagamentos)
+bot.add_command(definir_horario)
 bot.add_command(ajuda)
+
+# Persistent buttons: their state lives in the custom_id, so they survive
+# restarts without keeping a View per message in memory
+bot.add_dynamic_items(PaymentButton, DigestPaymentButton,
+                      ConfirmPaymentButton)
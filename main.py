@@ -1,7 +1,7 @@
 import os
 from bot import bot
-from webserver import keep_alive
 
 if __name__ == "__main__":
-    keep_alive()
     bot.run(os.getenv('DISCORD_BOT_TOKEN'))
+    # The loop is closed by now, so this writes synchronously
+    bot.stores.flush()
@@ -0,0 +1,153 @@
+import asyncio
+import contextlib
+import contextvars
+import functools
+import time
+
+# Latest value of each gauge, e.g. 'event_loop_lag_seconds'
+gauges = {}
+# (name, labels) -> running total
+counters = {}
+# (name, labels) -> [count, sum, max] of observed durations
+timers = {}
+
+# Handler (command, button or task) the current coroutine is running for,
+# so REST calls can be attributed to it
+current_handler = contextvars.ContextVar('current_handler', default='other')
+
+# Interactions must be answered within 3 seconds
+SLOW_HANDLER_SECONDS = 3.0
+LOG_INTERVAL = 300
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def set_gauge(name, value):
+    gauges[name] = value
+
+
+def inc(name, value=1, **labels):
+    key = _key(name, labels)
+    counters[key] = counters.get(key, 0) + value
+
+
+def observe(name, seconds, **labels):
+    key = _key(name, labels)
+    timer = timers.setdefault(key, [0, 0.0, 0.0])
+    timer[0] += 1
+    timer[1] += seconds
+    timer[2] = max(timer[2], seconds)
+
+
+def start_handler(name):
+    """Marks the running coroutine as handling name; see finish_handler."""
+    return name, current_handler.set(name), time.perf_counter()
+
+
+def finish_handler(state):
+    name, token, started = state
+    elapsed = time.perf_counter() - started
+    observe('handler_seconds', elapsed, handler=name)
+    if elapsed > SLOW_HANDLER_SECONDS:
+        inc('slow_handlers_total', handler=name)
+    current_handler.reset(token)
+
+
+@contextlib.contextmanager
+def handler(name):
+    """Times a handler and attributes the REST calls made inside it."""
+    state = start_handler(name)
+    try:
+        yield
+    finally:
+        finish_handler(state)
+
+
+def instrument(name):
+    """Decorator form of handler() for button callbacks."""
+
+    def decorator(func):
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with handler(name):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@contextlib.contextmanager
+def timed_job(name):
+    """Records how long a scheduled job took and when it last ran."""
+    started = time.perf_counter()
+    try:
+        with handler(f'task:{name}'):
+            yield
+    finally:
+        set_gauge(f'job_{name}_seconds', time.perf_counter() - started)
+        set_gauge(f'job_{name}_last_run_timestamp', time.time())
+
+
+def instrument_http(http):
+    """Counts every discord REST request, per handler."""
+    request = http.request
+
+    async def counted_request(route, **kwargs):
+        inc('discord_rest_calls_total', handler=current_handler.get())
+        return await request(route, **kwargs)
+
+    http.request = counted_request
+
+
+async def monitor_loop_lag(interval=1.0):
+    """Measures how late the event loop wakes up from a sleep."""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        set_gauge('event_loop_lag_seconds',
+                  max(0.0, loop.time() - started - interval))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+
+def prometheus_text():
+    """Exports every metric in the Prometheus text format."""
+    lines = []
+    for name, value in sorted(gauges.items()):
+        lines.append(f'spotifybot_{name} {value}')
+    for (name, labels), value in sorted(counters.items()):
+        lines.append(f'spotifybot_{name}{_format_labels(labels)} {value}')
+    for (name, labels), (count, total, peak) in sorted(timers.items()):
+        label_text = _format_labels(labels)
+        lines.append(f'spotifybot_{name}_count{label_text} {count}')
+        lines.append(f'spotifybot_{name}_sum{label_text} {total}')
+        lines.append(f'spotifybot_{name}_max{label_text} {peak}')
+    return '\n'.join(lines) + '\n'
+
+
+def summary_line():
+    """One-line digest of handler timings and REST calls."""
+    parts = []
+    for (name, labels), (count, total, peak) in sorted(timers.items()):
+        label = ','.join(str(v) for _, v in labels) or name
+        parts.append(
+            f"{label} n={count} avg={total / count:.3f}s max={peak:.3f}s")
+    for (name, labels), value in sorted(counters.items()):
+        label = ','.join(str(v) for _, v in labels)
+        parts.append(f"{name}[{label}]={value}")
+    return "metrics: " + (" | ".join(parts) or "no activity")
+
+
+async def log_periodically(interval=LOG_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        print(summary_line())
@@ -0,0 +1,113 @@
+import time
+import discord
+from reminders import ReminderDispatcher
+
+# Confirmations nobody answered within this long are expired
+PENDING_TTL = 7 * 24 * 60 * 60
+
+
+async def _drop_pending(store, keys):
+    """Removes the (user_id, year, month) entries, saving once at the end.
+
+    Returns {(user_id, year, month): info} for the entries still pending.
+    """
+    by_user = {}
+    for user_id, year, month in keys:
+        by_user.setdefault(user_id, []).append((year, month))
+    dropped = {}
+    for user_id, months in by_user.items():
+        async with store.lock(user_id):
+            for year, month in months:
+                info = store.remove_pending(user_id, year, month)
+                if info is not None:
+                    dropped[(user_id, year, month)] = info
+    await store.save()
+    return dropped
+
+
+def _edit_job(channel, message_id, content):
+
+    async def job():
+        try:
+            await channel.get_partial_message(message_id).edit(
+                content=content, view=None)
+        except discord.NotFound:
+            pass
+
+    return job
+
+
+async def expire_pending(store, confirmation_channel, commands_channel,
+                         now=None):
+    """Expires the confirmations older than PENDING_TTL, in bulk.
+
+    Each confirmation and !pagar reply is edited once, however many of its
+    months expired, through a bounded dispatcher. Returns how many
+    confirmations expired.
+    """
+    now = now or time.time()
+    dropped = await _drop_pending(store,
+                                  store.expired_pending(now - PENDING_TTL))
+    confirmation_months = {}
+    response_months = {}
+    for (user_id, year, month), info in dropped.items():
+        if info.get('confirmation_message_id'):
+            confirmation_months.setdefault(info['confirmation_message_id'],
+                                           (user_id, year, []))[2].append(month)
+        if info.get('response_message_id'):
+            response_months.setdefault(info['response_message_id'],
+                                       []).append(month)
+
+    days = PENDING_TTL // (24 * 60 * 60)
+    jobs = []
+    if confirmation_channel:
+        for message_id, (user_id, year,
+                         months) in confirmation_months.items():
+            jobs.append(
+                _edit_job(
+                    confirmation_channel, message_id,
+                    f"Payment for {', '.join(months).capitalize()}/{year} from <@{user_id}> expired after {days} days without an answer."
+                ))
+    if commands_channel:
+        for message_id, months in response_months.items():
+            jobs.append(
+                _edit_job(
+                    commands_channel, message_id,
+                    f"Payment intention for {', '.join(months).capitalize()} expired without admin confirmation. Please use !pagar again."
+                ))
+    if jobs:
+        await ReminderDispatcher().run(jobs)
+    return len(dropped)
+
+
+async def reconcile_pending(store, confirmation_channel):
+    """Drops confirmations whose message was deleted or lost its buttons.
+
+    Reads the channel history from the oldest pending message on, 100
+    messages per request, instead of fetching every message. Returns how
+    many confirmations were dropped.
+    """
+    message_ids = store.pending_message_ids()
+    if not message_ids or not confirmation_channel:
+        return 0
+    newest = max(message_ids)
+    live = set()
+    try:
+        async for message in confirmation_channel.history(
+                limit=None,
+                after=discord.Object(id=min(message_ids) - 1),
+                oldest_first=True):
+            if message.id > newest:
+                break
+            if message.components:
+                live.add(message.id)
+    except discord.HTTPException as e:
+        print(f"Could not read the confirmation channel history: {e}")
+        return 0
+    stale = [
+        key for message_id in message_ids if message_id not in live
+        for key in store.pending_for_message(message_id)
+    ]
+    if not stale:
+        return 0
+    return len(await _drop_pending(store, stale))
@@ -0,0 +1,110 @@
+import asyncio
+import discord
+from utils import chunk_lines
+
+MAX_CONCURRENT_SENDS = 10
+MAX_RETRIES = 3
+# Mentions per digest message (the 2000 character limit also applies)
+DIGEST_MAX_MENTIONS = 50
+
+
+class DispatchStats:
+    """Counts the outcome of one reminder batch."""
+
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+
+    def __str__(self):
+        return f"{self.sent} sent, {self.failed} failed, {self.retried} retried"
+
+
+class ReminderDispatcher:
+    """Runs reminder sends concurrently, bounded and retried on rate limits.
+
+    discord.py already queues requests per rate-limit bucket; the semaphore
+    keeps a large batch from flooding those queues all at once.
+    """
+
+    def __init__(self,
+                 max_concurrency=MAX_CONCURRENT_SENDS,
+                 max_retries=MAX_RETRIES):
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+
+    async def run(self, jobs):
+        """Runs every job (a coroutine function) and returns DispatchStats."""
+        stats = DispatchStats()
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def worker(job):
+            async with semaphore:
+                await self._attempt(job, stats)
+
+        await asyncio.gather(*(worker(job) for job in jobs))
+        return stats
+
+    async def _attempt(self, job, stats):
+        for attempt in range(self.max_retries + 1):
+            try:
+                await job()
+                stats.sent += 1
+                return
+            except discord.RateLimited as e:
+                delay = e.retry_after
+            except discord.HTTPException as e:
+                if e.status != 429 and e.status < 500:
+                    # Forbidden, unknown user... retrying won't help
+                    print(f"Reminder not sent: {e}")
+                    stats.failed += 1
+                    return
+                delay = 2**attempt
+            if attempt < self.max_retries:
+                stats.retried += 1
+                await asyncio.sleep(delay)
+        print("Reminder not sent: retries exhausted.")
+        stats.failed += 1
+
+
+async def send_reminders(bot, user_ids, render, make_view=None,
+                         channel=None):
+    """Sends one reminder per user, to the channel or else by DM.
+
+    render(user) builds the text and make_view(user_id), if given, the view.
+    """
+
+    def make_job(user_id):
+
+        async def job():
+            user = await bot.user_cache.get(user_id)
+            view = make_view(int(user_id)) if make_view else None
+            target = channel if channel else user
+            await target.send(render(user), view=view)
+
+        return job
+
+    return await ReminderDispatcher().run(
+        [make_job(user_id) for user_id in user_ids])
+
+
+async def send_digest(channel, user_ids, header, make_view=None):
+    """Mentions many users per message instead of one message per user.
+
+    make_view(), if given, builds the view attached to every message.
+    """
+    chunks = chunk_lines([f"<@{user_id}>" for user_id in user_ids],
+                         header=header,
+                         max_lines=DIGEST_MAX_MENTIONS,
+                         separator=' ')
+
+    def make_job(content):
+
+        async def job():
+            view = make_view() if make_view else None
+            await channel.send(content, view=view)
+
+        return job
+
+    return await ReminderDispatcher().run(
+        [make_job(content) for content in chunks])
@@ -0,0 +1,42 @@
+from collections import OrderedDict
+from utils import month_translation
+
+RENDER_CACHE_SIZE = 5000
+
+
+def render_months(payments):
+    """The 12-line ✅/❌ list shown by !pagamentos."""
+    return "".join(f"{mes.capitalize()}: {'✅' if payments.get(mes) else '❌'}\n"
+                   for mes in month_translation.values())
+
+
+class RenderCache:
+    """Keeps each user's rendered year until the store says it changed.
+
+    Entries are keyed by (store, user_id, year) and remember the version
+    they were rendered at, so a payment change misses once and replaces
+    the stale text instead of piling up next to it.
+    """
+
+    def __init__(self, maxsize=RENDER_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, store, user_id, year):
+        """Returns the rendered months of the user's year."""
+        key = (store.directory, str(user_id), str(year))
+        version = store.version(user_id)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == version:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        text = render_months(store.get_user_payments(user_id, year))
+        self._entries[key] = (version, text)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return text
@@ -0,0 +1,127 @@
+import asyncio
+import datetime
+import json
+import os
+from utils import atomic_write
+
+# The reminders' timezone (UTC+1)
+TIMEZONE = datetime.timezone(datetime.timedelta(hours=1))
+# Upper bound on one sleep, so a suspended host or a clock change is noticed
+MAX_SLEEP = 60 * 60
+
+
+def shift_month(year, month, delta):
+    """Returns (year, month) delta months away."""
+    index = year * 12 + month - 1 + delta
+    return index // 12, index % 12 + 1
+
+
+class MonthlyJob:
+    """A job that fires once a month, on a day (1-28) at an aware time.
+
+    run(scheduled) gets the fire time it runs for, not the current time,
+    so a late run still works on the period it was due for. catch_up is
+    how late a missed run may still happen; past it the period is
+    skipped.
+    """
+
+    def __init__(self, name, day, at, run, catch_up):
+        self.name = name
+        self.day = day
+        self.at = at
+        self.run = run
+        self.catch_up = catch_up
+
+    def fire_time(self, year, month):
+        return datetime.datetime.combine(datetime.date(year, month, self.day),
+                                         self.at)
+
+    def previous_fire(self, now):
+        """Returns the latest fire time at or before now."""
+        local = now.astimezone(self.at.tzinfo)
+        fire = self.fire_time(local.year, local.month)
+        if fire > now:
+            fire = self.fire_time(*shift_month(local.year, local.month, -1))
+        return fire
+
+    def next_fire(self, now):
+        """Returns the earliest fire time after now."""
+        local = now.astimezone(self.at.tzinfo)
+        fire = self.fire_time(local.year, local.month)
+        if fire <= now:
+            fire = self.fire_time(*shift_month(local.year, local.month, 1))
+        return fire
+
+
+class Scheduler:
+    """Runs each job once per period and remembers what already ran.
+
+    The last fire time handled per job is kept in a small JSON file, so
+    a restart neither repeats a run nor, within the job's catch_up,
+    misses one that fell while the bot was offline. Between runs it
+    sleeps until the next fire time instead of waking up daily to
+    compare dates.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.jobs = []
+        self.markers = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self.markers = json.load(f)
+            except json.JSONDecodeError:
+                print(f"Corrupted {path}, starting from the next fire times.")
+
+    def add(self, job):
+        self.jobs.append(job)
+
+    def mark(self, job, scheduled):
+        self.markers[job.name] = int(scheduled.timestamp())
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        atomic_write(self.path, json.dumps(self.markers))
+
+    async def run_due(self, now):
+        """Runs every job whose latest fire time hasn't been handled."""
+        for job in self.jobs:
+            due = job.previous_fire(now)
+            if self.markers.get(job.name, 0) >= due.timestamp():
+                continue
+            # On the very first start there's no backlog to catch up on
+            if job.name in self.markers:
+                await self.run_job(job, due, now)
+            self.mark(job, due)
+
+    async def run_job(self, job, due, now):
+        if now - due > job.catch_up:
+            print(f"Skipped {job.name} due {due:%Y-%m-%d %H:%M %z}: "
+                  f"missed by more than {job.catch_up}.")
+            return
+        try:
+            await job.run(due)
+        except Exception as e:
+            print(f"{job.name} failed for {due:%Y-%m-%d}: {e}")
+
+    async def run(self):
+        """Runs the jobs forever, catching up first."""
+        while True:
+            await self.run_due(datetime.datetime.now(datetime.timezone.utc))
+            now = datetime.datetime.now(datetime.timezone.utc)
+            wake = min(job.next_fire(now) for job in self.jobs)
+            await asyncio.sleep(
+                min(max((wake - now).total_seconds(), 0), MAX_SLEEP))
+
+
+def claim(store, name, scheduled):
+    """Records the guild's run of a period; False if it already ran.
+
+    The marker is set before anything is sent, so a run interrupted
+    midway is not repeated: a reminder is better missed than doubled.
+    """
+    key = f'last_run_{name}'
+    stamp = int(scheduled.timestamp())
+    if store.settings.get(key, 0) >= stamp:
+        return False
+    store.set_setting(key, stamp)
+    return True
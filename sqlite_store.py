@@ -0,0 +1,382 @@
+import asyncio
+import os
+import sqlite3
+import time
+from store import RESERVED_KEYS, StoreBase, load_nested_payments
+from utils import (PAYMENTS_FILE, PaymentWriter, migrate_payment_masks,
+                   month_translation, month_bits)
+
+DATABASE_FILE = 'payments.db'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS payments (
+    user_id TEXT NOT NULL,
+    year TEXT NOT NULL,
+    month TEXT NOT NULL,
+    paid INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, year, month)
+);
+CREATE INDEX IF NOT EXISTS payments_by_month
+    ON payments (year, month, paid);
+CREATE TABLE IF NOT EXISTS pending_payments (
+    user_id TEXT NOT NULL,
+    year TEXT NOT NULL,
+    month TEXT NOT NULL,
+    confirmation_message_id INTEGER,
+    response_message_id INTEGER,
+    created_at INTEGER,
+    PRIMARY KEY (user_id, year, month)
+);
+CREATE INDEX IF NOT EXISTS pending_by_confirmation
+    ON pending_payments (confirmation_message_id);
+CREATE TABLE IF NOT EXISTS settings (
+    name TEXT PRIMARY KEY,
+    value INTEGER
+);
+CREATE TABLE IF NOT EXISTS reminder_preferences (
+    user_id TEXT PRIMARY KEY,
+    hour INTEGER NOT NULL,
+    timezone TEXT
+);
+"""
+
+
+class SqlitePaymentStore(StoreBase):
+    """PaymentStore backed by an indexed SQLite database."""
+
+    def __init__(self, directory='.'):
+        super().__init__()
+        self.directory = directory
+        self.path = os.path.join(directory, DATABASE_FILE)
+        self.db = None
+        # Commits and the roster-wide queries run off the event loop; the
+        # connection is shared with it, which SQLite serializes
+        self.writer = PaymentWriter()
+        self.settings = {}
+        # (user_id, year) pairs known to have all 12 month rows
+        self._known = set()
+
+    async def load(self):
+        """Opens the database, migrating payments.json on first use."""
+        if self.loaded:
+            return
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        self.upgrade_pending()
+        if not self.imported():
+            await asyncio.get_running_loop().run_in_executor(
+                None, self.migrate_from_json)
+        self.settings = dict(
+            self.db.execute("SELECT name, value FROM settings"))
+        self.loaded = True
+
+    def imported(self):
+        """Whether payments.json was imported, or there is nothing to import.
+
+        The json_imported marker is written in the import's transaction, so
+        an import that failed halfway is retried on the next start instead
+        of leaving an empty ledger. Databases from before the marker that
+        already hold users count as imported.
+        """
+        if self.db.execute("SELECT 1 FROM settings WHERE name = ?",
+                           ('json_imported', )).fetchone():
+            return True
+        if self.db.execute("SELECT 1 FROM users LIMIT 1").fetchone():
+            self.db.execute("INSERT INTO settings VALUES (?, ?)",
+                            ('json_imported', 1))
+            self.db.commit()
+            return True
+        return False
+
+    def upgrade_pending(self):
+        """Adds created_at to databases from before pending expiry."""
+        columns = {
+            row[1]
+            for row in self.db.execute("PRAGMA table_info(pending_payments)")
+        }
+        if 'created_at' not in columns:
+            self.db.execute(
+                "ALTER TABLE pending_payments ADD COLUMN created_at INTEGER")
+        self.db.execute("CREATE INDEX IF NOT EXISTS pending_by_age "
+                        "ON pending_payments (created_at)")
+        # The TTL of older entries starts now
+        self.db.execute(
+            "UPDATE pending_payments SET created_at = ? "
+            "WHERE created_at IS NULL", (int(time.time()), ))
+        self.db.commit()
+
+    def migrate_from_json(self):
+        """Imports the existing payments.json into the database once."""
+        json_path = os.path.join(self.directory, PAYMENTS_FILE)
+        payments = load_nested_payments(json_path)
+        migrate_payment_masks(payments)
+        db = sqlite3.connect(self.path)
+        with db:
+            for name, value in payments.get('settings', {}).items():
+                db.execute("INSERT OR REPLACE INTO settings VALUES (?, ?)",
+                           (name, value))
+            for user_id, years in payments.get('pending_payments',
+                                               {}).items():
+                for year, months in years.items():
+                    for month, info in months.items():
+                        db.execute(
+                            "INSERT OR REPLACE INTO pending_payments "
+                            "VALUES (?, ?, ?, ?, ?, ?)",
+                            (user_id, year, month,
+                             info.get('confirmation_message_id'),
+                             info.get('response_message_id'),
+                             info.get('created_at', int(time.time()))))
+            for user_id, preference in payments.get('reminder_preferences',
+                                                    {}).items():
+                db.execute(
+                    "INSERT OR REPLACE INTO reminder_preferences "
+                    "VALUES (?, ?, ?)",
+                    (user_id, preference['hour'], preference['timezone']))
+            for user_id, years in payments.items():
+                if user_id in RESERVED_KEYS:
+                    continue
+                db.execute("INSERT OR IGNORE INTO users VALUES (?)",
+                           (user_id, ))
+                db.executemany(
+                    "INSERT OR REPLACE INTO payments VALUES (?, ?, ?, ?)",
+                    [(user_id, year, month, int(bool(mask & bit)))
+                     for year, mask in years.items()
+                     for month, bit in month_bits.items()])
+            db.execute("INSERT OR REPLACE INTO settings VALUES (?, ?)",
+                       ('json_imported', 1))
+        db.close()
+        if os.path.exists(json_path):
+            print(f"payments.json migrated to {self.path}.")
+
+    def save_soon(self):
+        """Commits pending changes on the writer, in call order.
+
+        SQLite writes are already incremental; only the commit waits.
+        """
+        self._cancel_scheduled_save()
+        if not self.dirty:
+            return None
+        self.dirty.clear()
+        return self.writer.submit(self._commit)
+
+    def _commit(self):
+        self.db.commit()
+        return True
+
+    def flush(self):
+        if not self.loaded:
+            return False
+        self.save_soon()
+        return True
+
+    def set_setting(self, name, value):
+        if self.settings.get(name) != value:
+            self.settings[name] = value
+            self.db.execute("INSERT OR REPLACE INTO settings VALUES (?, ?)",
+                            (name, value))
+            self.dirty.add('settings')
+
+    def user_ids(self):
+        return [
+            row[0]
+            for row in self.db.execute("SELECT user_id FROM users "
+                                       "ORDER BY rowid")
+        ]
+
+    def user_count(self):
+        return self.db.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def has_user(self, user_id):
+        return self.db.execute("SELECT 1 FROM users WHERE user_id = ?",
+                               (str(user_id), )).fetchone() is not None
+
+    def get_years(self, user_id):
+        return [
+            row[0] for row in self.db.execute(
+                "SELECT DISTINCT year FROM payments WHERE user_id = ?",
+                (str(user_id), ))
+        ]
+
+    async def years(self):
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self._years)
+
+    def _years(self):
+        return sorted((row[0] for row in self.db.execute(
+            "SELECT DISTINCT year FROM payments")),
+                      key=int)
+
+    async def year_masks(self, year):
+        """Returns (user_id, mask) for the users with rows for the year."""
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self._year_masks, str(year))
+
+    def _year_masks(self, year):
+        masks = {}
+        for user_id, month, paid in self.db.execute(
+                "SELECT p.user_id, p.month, p.paid FROM payments p "
+                "JOIN users u ON u.user_id = p.user_id "
+                "WHERE p.year = ? ORDER BY u.rowid", (year, )):
+            masks[user_id] = masks.get(user_id, 0) | (month_bits[month]
+                                                      if paid else 0)
+        return list(masks.items())
+
+    def ensure_user_month(self, user_id, year, month):
+        """Ensures the user has rows for the year; True if any were created."""
+        user_id = str(user_id)
+        year = str(year)
+        if (user_id, year) in self._known:
+            return False
+        self.reopen(year)
+        self._known.add((user_id, year))
+        created = self.db.execute("INSERT OR IGNORE INTO users VALUES (?)",
+                                  (user_id, )).rowcount
+        created += self.db.executemany(
+            "INSERT OR IGNORE INTO payments (user_id, year, month) "
+            "VALUES (?, ?, ?)",
+            [(user_id, year, m) for m in month_translation.values()]).rowcount
+        if created:
+            self.touch(user_id)
+            self.dirty.add(user_id)
+        return bool(created)
+
+    def set_payment_status(self, user_id, year, month, status):
+        user_id = str(user_id)
+        year = str(year)
+        self.reopen(year)
+        self.ensure_user_month(user_id, year, month)
+        self.db.execute(
+            "UPDATE payments SET paid = ? "
+            "WHERE user_id = ? AND year = ? AND month = ?",
+            (int(bool(status)), user_id, year, month))
+        self.touch(user_id)
+        self.dirty.add(user_id)
+
+    def is_month_paid(self, user_id, year, month_en):
+        month_pt = month_translation.get(month_en.lower(), month_en.lower())
+        row = self.db.execute(
+            "SELECT paid FROM payments "
+            "WHERE user_id = ? AND year = ? AND month = ?",
+            (str(user_id), str(year), month_pt)).fetchone()
+        return bool(row and row[0])
+
+    def get_user_payments(self, user_id, year):
+        payments = {m: False for m in month_translation.values()}
+        for month, paid in self.db.execute(
+                "SELECT month, paid FROM payments "
+                "WHERE user_id = ? AND year = ?", (str(user_id), str(year))):
+            payments[month] = bool(paid)
+        return payments
+
+    async def month_status(self, year, month):
+        """Returns (user_id, paid) for every registered user."""
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self._month_status, str(year), month)
+
+    def _month_status(self, year, month):
+        return [(user_id, bool(paid)) for user_id, paid in self.db.execute(
+            "SELECT u.user_id, COALESCE(p.paid, 0) FROM users u "
+            "LEFT JOIN payments p ON p.user_id = u.user_id "
+            "AND p.year = ? AND p.month = ? ORDER BY u.rowid",
+            (year, month))]
+
+    async def unpaid_users(self, year, month):
+        """Returns the users that haven't paid the month, in one query."""
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self._unpaid_users, str(year), month)
+
+    def _unpaid_users(self, year, month):
+        return [
+            row[0] for row in self.db.execute(
+                "SELECT u.user_id FROM users u "
+                "LEFT JOIN payments p ON p.user_id = u.user_id "
+                "AND p.year = ? AND p.month = ? "
+                "WHERE COALESCE(p.paid, 0) = 0 ORDER BY u.rowid",
+                (year, month))
+        ]
+
+    def get_preference(self, user_id):
+        row = self.db.execute(
+            "SELECT hour, timezone FROM reminder_preferences "
+            "WHERE user_id = ?", (str(user_id), )).fetchone()
+        if row is None:
+            return None
+        return {'hour': row[0], 'timezone': row[1]}
+
+    def set_preference(self, user_id, hour, timezone=None):
+        if hour is None:
+            self.db.execute(
+                "DELETE FROM reminder_preferences WHERE user_id = ?",
+                (str(user_id), ))
+        else:
+            self.db.execute(
+                "INSERT OR REPLACE INTO reminder_preferences "
+                "VALUES (?, ?, ?)", (str(user_id), hour, timezone))
+        self.dirty.add('reminder_preferences')
+
+    def get_pending(self, user_id, year, month):
+        row = self.db.execute(
+            "SELECT confirmation_message_id, response_message_id, created_at "
+            "FROM pending_payments "
+            "WHERE user_id = ? AND year = ? AND month = ?",
+            (str(user_id), str(year), month)).fetchone()
+        if row is None:
+            return None
+        info = {}
+        if row[0] is not None:
+            info['confirmation_message_id'] = row[0]
+        if row[1] is not None:
+            info['response_message_id'] = row[1]
+        info['created_at'] = row[2]
+        return info
+
+    def add_pending(self, user_id, year, month, **info):
+        self.db.execute(
+            "INSERT OR IGNORE INTO pending_payments "
+            "(user_id, year, month, created_at) VALUES (?, ?, ?, ?)",
+            (str(user_id), str(year), month, int(time.time())))
+        for column in ('confirmation_message_id', 'response_message_id'):
+            if column in info:
+                self.db.execute(
+                    f"UPDATE pending_payments SET {column} = ? "
+                    "WHERE user_id = ? AND year = ? AND month = ?",
+                    (info[column], str(user_id), str(year), month))
+        self.dirty.add('pending_payments')
+
+    def remove_pending(self, user_id, year, month):
+        info = self.get_pending(user_id, year, month)
+        if info is None:
+            return None
+        self.db.execute(
+            "DELETE FROM pending_payments "
+            "WHERE user_id = ? AND year = ? AND month = ?",
+            (str(user_id), str(year), month))
+        self.dirty.add('pending_payments')
+        return info
+
+    def pending_for_message(self, message_id):
+        return [
+            tuple(row) for row in self.db.execute(
+                "SELECT user_id, year, month FROM pending_payments "
+                "WHERE confirmation_message_id = ?", (message_id, ))
+        ]
+
+    def pending_message_ids(self):
+        return [
+            row[0] for row in self.db.execute(
+                "SELECT DISTINCT confirmation_message_id "
+                "FROM pending_payments "
+                "WHERE confirmation_message_id IS NOT NULL")
+        ]
+
+    def expired_pending(self, cutoff):
+        return [
+            tuple(row) for row in self.db.execute(
+                "SELECT user_id, year, month FROM pending_payments "
+                "WHERE created_at < ? ORDER BY created_at", (cutoff, ))
+        ]
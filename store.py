@@ -0,0 +1,763 @@
+import asyncio
+import contextlib
+import datetime
+import os
+import time
+import weakref
+from collections import OrderedDict
+import shutil
+from utils import (PAYMENTS_FILE, RESERVED_KEYS, PaymentWriter,
+                   load_payments, load_payments_async, save_payments,
+                   save_payments_async, append_journal_async,
+                   journal_has_entries, journal_path, partition_path,
+                   load_partition, compact_partition, save_partition,
+                   save_partition_async, migrate_payment_masks,
+                   month_translation, month_bits, year_bit, mask_to_years)
+
+# Batched writes: flush at most every FLUSH_DELAY seconds, or right away once
+# FLUSH_THRESHOLD entries are waiting.
+FLUSH_DELAY = 30
+FLUSH_THRESHOLD = 50
+# Journal entries appended before a compacted snapshot replaces them
+COMPACT_THRESHOLD = 1000
+# Years kept in memory at once; the current year is never evicted
+LOADED_YEARS = 3
+
+
+def gather_writes(futures):
+    """Combines background writes into one future, True if all succeeded."""
+    futures = [future for future in futures if future is not None]
+    if len(futures) <= 1:
+        return futures[0] if futures else None
+    return asyncio.ensure_future(_all_written(futures))
+
+
+async def _all_written(futures):
+    return all(await asyncio.gather(*futures))
+
+
+class StoreBase:
+    """Batching and per-user locking shared by every storage backend."""
+
+    def __init__(self):
+        self.dirty = set()
+        self.loaded = False
+        self._flush_handle = None
+        # Locks disappear on their own once no coroutine holds or awaits them
+        self._locks = weakref.WeakValueDictionary()
+        # Bumped on every change to a user's records, so rendered text can
+        # be cached
+        self._versions = {}
+
+    def save_soon(self):
+        raise NotImplementedError
+
+    async def load_year(self, year):
+        """Loads a year ahead of use; a no-op for backends that query."""
+
+    async def save(self):
+        """Writes the changes and waits until they are on disk."""
+        if not self.dirty:
+            return False
+        future = self.save_soon()
+        if future is None:
+            return True
+        return await future
+
+    def schedule_save(self):
+        """Batches writes on a debounce timer or a size threshold."""
+        if not self.dirty:
+            return
+        if len(self.dirty) >= FLUSH_THRESHOLD:
+            self.save_soon()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(
+                FLUSH_DELAY, self.save_soon)
+
+    def _cancel_scheduled_save(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+    def archived(self, year):
+        """Whether the year is closed: kept for reading, no longer written."""
+        return (int(year) <= self.settings.get('archived_through', 0) and
+                not self.settings.get('reopened_years', 0) & year_bit(year))
+
+    def rollover(self, year):
+        """Closes the years before the given one, without rewriting them.
+
+        Only settings change: the new year's records are created as users
+        show up and the closed years stay as they are. Years reopened by
+        late changes are closed again. Returns True if any year was
+        closed.
+        """
+        closed = int(year) - 1
+        if self.settings.get('archived_through', 0) >= closed:
+            return False
+        self.set_setting('archived_through', closed)
+        self.set_setting('reopened_years', 0)
+        return True
+
+    def reopen(self, year):
+        """Lets a late change (e.g. a confirmation) into a closed year.
+
+        Only that year reopens; the years after it stay closed.
+        """
+        if self.archived(year):
+            print(f"Reopening the archived year {year} for a late change.")
+            self.set_setting('reopened_years',
+                             self.settings.get('reopened_years', 0) |
+                             year_bit(year))
+
+    def version(self, user_id):
+        """Returns a value that changes whenever the user's records do."""
+        return self._versions.get(str(user_id), 0)
+
+    def touch(self, user_id):
+        user_id = str(user_id)
+        self._versions[user_id] = self._versions.get(user_id, 0) + 1
+
+    def lock(self, user_id):
+        """Returns the lock guarding one user's records."""
+        user_id = str(user_id)
+        lock = self._locks.get(user_id)
+        if lock is None:
+            lock = self._locks[user_id] = asyncio.Lock()
+        return lock
+
+    @contextlib.asynccontextmanager
+    async def locked(self, user_id):
+        """Holds the user's lock for the block and saves changes on exit.
+
+        Updates to unrelated users run in parallel; updates to the same
+        user (load, awaits, mutate) no longer interleave.
+        """
+        async with self.lock(user_id):
+            yield self
+            self.save_soon()
+
+
+class YearPartition:
+    """One year's payments (user_id -> month mask) with its own journal."""
+
+    def __init__(self, path):
+        self.path = path
+        self.masks = {}
+        self.journal_entries = 0
+        self.last_write = None
+
+    def load(self):
+        # The journal keeps counting from where the last process left it,
+        # so it's compacted at the threshold however often we restart
+        self.masks, self.journal_entries = load_partition(self.path)
+        return self
+
+    def writing(self):
+        """Whether a write is queued, or failed and must not be dropped."""
+        return self.last_write is not None and (
+            not self.last_write.done() or not self.last_write.result())
+
+    def journal(self, user_ids, writer):
+        self.journal_entries += len(user_ids)
+        self.last_write = append_journal_async(
+            [(user_id, self.masks.get(user_id)) for user_id in user_ids],
+            journal_path(self.path), writer)
+        return self.last_write
+
+    def save_snapshot(self, writer):
+        self.journal_entries = 0
+        self.last_write = save_partition_async(self.masks, self.path, writer)
+        return self.last_write
+
+    def flush(self):
+        self.journal_entries = 0
+        return save_partition(self.masks, self.path)
+
+
+class PaymentStore(StoreBase):
+    """Keeps the roster in memory and each year in its own partition.
+
+    payments.json holds the settings, the pending confirmations and, per
+    user, a mask of the years they have records for; each year's month
+    masks live in payments-<year>.json with their own journal. Years are
+    read on first use and the least recently used are dropped once more
+    than LOADED_YEARS are in memory, so startup only reads the roster and
+    the current year however much history accumulates.
+
+    Changes to a year are tracked in dirty as (year, user_id) pairs.
+    """
+
+    def __init__(self, directory='.'):
+        super().__init__()
+        self.directory = directory
+        self.path = os.path.join(directory, PAYMENTS_FILE)
+        # Each store writes on its own task, so a large guild's snapshot
+        # doesn't hold up a small guild's journal appends
+        self.writer = PaymentWriter()
+        self.payments = {key: {} for key in RESERVED_KEYS}
+        self.journal_entries = 0
+        # year -> YearPartition, least recently used first
+        self._years = OrderedDict()
+        # (year, month) -> ids of users who haven't paid it; each entry is
+        # built on first use and then kept up to date by every change
+        self._unpaid = {}
+        # Pending confirmations oldest first, so expiry pops from the
+        # front, and by confirmation message for the reconciliation
+        self._pending_queue = OrderedDict()
+        self._pending_by_message = {}
+
+    async def load(self):
+        """Loads the roster and the current year once."""
+        if self.loaded:
+            return
+        self.payments = await load_payments_async(self.path)
+        for key in RESERVED_KEYS:
+            self.payments.setdefault(key, {})
+        self.dirty.clear()
+        self.loaded = True
+        self._index_pending()
+        split = self._split_years()
+        if split or journal_has_entries(journal_path(self.path)):
+            # Fold the replayed journal (or the old layout) into snapshots
+            self.save_snapshot()
+        await self.load_year(datetime.date.today().year)
+
+    def _split_years(self):
+        """Moves the years of the single-file layout into partitions."""
+        old_users = [
+            user_id for user_id in self.user_ids()
+            if isinstance(self.payments[user_id], dict)
+        ]
+        if not old_users:
+            return False
+        migrate_payment_masks(self.payments)
+        for user_id in old_users:
+            years = 0
+            for year, mask in self.payments[user_id].items():
+                if not year.isdigit():
+                    continue
+                # Every year stays loaded until save_snapshot wrote it
+                partition = self._years.get(year)
+                if partition is None:
+                    partition = self._years[year] = YearPartition(
+                        partition_path(self.path, year)).load()
+                partition.masks[user_id] = mask
+                years |= year_bit(year)
+            self.payments[user_id] = years
+        return True
+
+    def _partition(self, year):
+        """Returns the year's partition, reading it if it isn't loaded."""
+        year = str(year)
+        partition = self._years.get(year)
+        if partition is None:
+            partition = self._years[year] = YearPartition(
+                partition_path(self.path, year)).load()
+        else:
+            self._years.move_to_end(year)
+        self._evict()
+        return partition
+
+    async def load_year(self, year):
+        """Reads the year's partition off the event loop, if not loaded."""
+        year = str(year)
+        if year in self._years:
+            return
+        partition = await asyncio.get_running_loop().run_in_executor(
+            None,
+            YearPartition(partition_path(self.path, year)).load)
+        # Unless a synchronous read got there first
+        if year not in self._years:
+            self._years[year] = partition
+            self._evict()
+
+    def _evict(self):
+        """Drops the least recently used years with nothing left to write."""
+        if len(self._years) <= LOADED_YEARS:
+            return
+        unsaved = {key[0] for key in self.dirty if isinstance(key, tuple)}
+        current_year = str(datetime.date.today().year)
+        # The most recent use (the last one) is about to be read
+        for year, partition in list(self._years.items())[:-1]:
+            if len(self._years) <= LOADED_YEARS:
+                break
+            if (year != current_year and year not in unsaved
+                    and not partition.writing()):
+                del self._years[year]
+
+    def save_soon(self):
+        """Writes the changes in the background, in call order.
+
+        Changed entries are appended to the roster's or the year's
+        journal; once one grows past COMPACT_THRESHOLD a compacted
+        snapshot replaces it. Returns a future (or None when nothing
+        changed) that callers may await or ignore.
+        """
+        self._cancel_scheduled_save()
+        if not self.dirty:
+            return None
+        writes = self._journal_dirty()
+        for partition in self._years.values():
+            if partition.journal_entries >= COMPACT_THRESHOLD:
+                writes.append(partition.save_snapshot(self.writer))
+        if self.journal_entries >= COMPACT_THRESHOLD:
+            writes.append(self._save_roster_snapshot())
+        return gather_writes(writes)
+
+    def _journal_dirty(self):
+        """Appends the changed entries to the roster's and years' journals.
+
+        Changes are journaled even when a snapshot follows: a crash after
+        the snapshot replaced its file but before the journal was cleared
+        then replays the same values over it, not older ones.
+        """
+        keys = []
+        changed_years = {}
+        for key in self.dirty:
+            if isinstance(key, tuple):
+                changed_years.setdefault(key[0], []).append(key[1])
+            else:
+                keys.append(key)
+        self.dirty.clear()
+        writes = [
+            self._years[year].journal(user_ids, self.writer)
+            for year, user_ids in changed_years.items()
+        ]
+        if keys:
+            self.journal_entries += len(keys)
+            writes.append(
+                append_journal_async([(key, self.payments.get(key))
+                                      for key in keys],
+                                     journal_path(self.path), self.writer))
+        return writes
+
+    def save_snapshot(self):
+        """Writes compacted snapshots of the loaded years and the roster.
+
+        The years go first, so the roster never lists a year whose
+        partition isn't on disk yet.
+        """
+        writes = self._journal_dirty()
+        writes.extend(
+            partition.save_snapshot(self.writer)
+            for partition in self._years.values())
+        writes.append(self._save_roster_snapshot())
+        return gather_writes(writes)
+
+    def _save_roster_snapshot(self):
+        self.journal_entries = 0
+        return save_payments_async(self.payments,
+                                   self.settings.get('lembrete_channel_id'),
+                                   self.settings.get('commands_channel_id'),
+                                   self.settings.get('confirmation_channel_id'),
+                                   self.path, self.writer)
+
+    def flush(self):
+        """Synchronously writes the whole store, e.g. after the loop stopped."""
+        if not self.loaded:
+            return False
+        # With no running loop the writer appends these right away
+        self._journal_dirty()
+        self.journal_entries = 0
+        written = all([partition.flush() for partition in self._years.values()])
+        return save_payments(self.payments,
+                             self.settings.get('lembrete_channel_id'),
+                             self.settings.get('commands_channel_id'),
+                             self.settings.get('confirmation_channel_id'),
+                             self.path) and written
+
+    @property
+    def settings(self):
+        return self.payments['settings']
+
+    def set_setting(self, name, value):
+        """Updates a setting, marking it dirty only if it changed."""
+        if self.settings.get(name) != value:
+            self.settings[name] = value
+            self.dirty.add('settings')
+
+    def user_ids(self):
+        """Returns the ids of all registered users."""
+        return [uid for uid in self.payments if uid not in RESERVED_KEYS]
+
+    def user_count(self):
+        return len(self.payments) - len(RESERVED_KEYS)
+
+    def has_user(self, user_id):
+        user_id = str(user_id)
+        return user_id in self.payments and user_id not in RESERVED_KEYS
+
+    def get_years(self, user_id):
+        """Returns the years registered for a user."""
+        if not self.has_user(user_id):
+            return []
+        return mask_to_years(self.payments[str(user_id)])
+
+    async def years(self):
+        """Returns every year anyone has a record for, oldest first."""
+        return self._recorded_years()
+
+    def _recorded_years(self):
+        years = 0
+        for user_id in self.user_ids():
+            years |= self.payments[user_id]
+        return mask_to_years(years)
+
+    async def year_masks(self, year):
+        """Returns (user_id, mask) for the users with a record for the year."""
+        await self.load_year(year)
+        return list(self._partition(year).masks.items())
+
+    def get_mask(self, user_id, year):
+        """Returns the user's paid months of the year, without creating it."""
+        user_id = str(user_id)
+        if not self.has_user(user_id):
+            return 0
+        if not self.payments[user_id] & year_bit(year):
+            return 0
+        return self._partition(year).masks.get(user_id, 0)
+
+    def ensure_user_month(self, user_id, year, month):
+        """Ensures the user has an entry for the year/month.
+
+        Returns True if the entry had to be created.
+        """
+        user_id = str(user_id)
+        year = str(year)
+        is_new_user = not self.has_user(user_id)
+        if not is_new_user and self.payments[user_id] & year_bit(year):
+            return False
+        self.reopen(year)
+        self.payments[user_id] = self.payments.get(user_id,
+                                                   0) | year_bit(year)
+        self._partition(year).masks.setdefault(user_id, 0)
+        if is_new_user:
+            # A new user hasn't paid anything yet
+            for unpaid in self._unpaid.values():
+                unpaid.add(user_id)
+        self.touch(user_id)
+        self.dirty.add(user_id)
+        self.dirty.add((year, user_id))
+        return True
+
+    def set_payment_status(self, user_id, year, month, status):
+        user_id = str(user_id)
+        year = str(year)
+        self.reopen(year)
+        self.ensure_user_month(user_id, year, month)
+        masks = self._partition(year).masks
+        if status:
+            masks[user_id] |= month_bits[month]
+        else:
+            masks[user_id] &= ~month_bits[month]
+        unpaid = self._unpaid.get((year, month))
+        if unpaid is not None:
+            if status:
+                unpaid.discard(user_id)
+            else:
+                unpaid.add(user_id)
+        self.touch(user_id)
+        self.dirty.add((year, user_id))
+
+    def is_month_paid(self, user_id, year, month_en):
+        month = month_translation.get(month_en.lower(), month_en.lower())
+        return bool(self.get_mask(user_id, year) & month_bits[month])
+
+    def get_user_payments(self, user_id, year):
+        mask = self.get_mask(user_id, year)
+        return {month: bool(mask & bit) for month, bit in month_bits.items()}
+
+    async def month_status(self, year, month):
+        """Returns (user_id, paid) for every registered user."""
+        await self.load_year(year)
+        return self._month_status(year, month)
+
+    def _month_status(self, year, month):
+        masks = self._partition(year).masks
+        bit = month_bits[month]
+        return [(user_id, bool(masks.get(user_id, 0) & bit))
+                for user_id in self.user_ids()]
+
+    async def unpaid_users(self, year, month):
+        """Returns the users that haven't paid the month, from the index."""
+        key = (str(year), month)
+        unpaid = self._unpaid.get(key)
+        if unpaid is None:
+            await self.load_year(year)
+            unpaid = self._unpaid[key] = {
+                user_id
+                for user_id, paid in self._month_status(year, month)
+                if not paid
+            }
+        return list(unpaid)
+
+    def get_preference(self, user_id):
+        """Returns the user's {'hour', 'timezone'} for reminders, or None."""
+        return self.payments['reminder_preferences'].get(str(user_id))
+
+    def set_preference(self, user_id, hour, timezone=None):
+        """Sets when the user's reminders go out; hour None clears it."""
+        if hour is None:
+            self.payments['reminder_preferences'].pop(str(user_id), None)
+        else:
+            self.payments['reminder_preferences'][str(user_id)] = {
+                'hour': hour,
+                'timezone': timezone
+            }
+        self.dirty.add('reminder_preferences')
+
+    def rollover(self, year):
+        """Closes the years before the given one and compacts them.
+
+        Each closed year's journal is folded into a single snapshot once,
+        on the writer, so reading an archived year never writes.
+        """
+        if not super().rollover(year):
+            return False
+        for key in list(self._unpaid):
+            if self.archived(key[0]):
+                del self._unpaid[key]
+        writes = self._journal_dirty()
+        for closed in self._recorded_years():
+            if not self.archived(closed):
+                continue
+            partition = self._years.get(closed)
+            if partition is not None:
+                writes.append(partition.save_snapshot(self.writer))
+            else:
+                writes.append(
+                    self.writer.submit(compact_partition,
+                                       partition_path(self.path, closed)))
+        gather_writes(writes)
+        return True
+
+    @property
+    def pending(self):
+        return self.payments['pending_payments']
+
+    def _index_pending(self):
+        now = int(time.time())
+        entries = []
+        for user_id, years in self.pending.items():
+            for year, months in years.items():
+                for month, info in months.items():
+                    if 'created_at' not in info:
+                        # Made before expiry existed: the TTL starts now
+                        info['created_at'] = now
+                        self.dirty.add('pending_payments')
+                    entries.append((info['created_at'], user_id, year, month))
+        self._pending_queue.clear()
+        self._pending_by_message.clear()
+        for created_at, user_id, year, month in sorted(entries):
+            self._index_pending_entry((user_id, year, month),
+                                      self.pending[user_id][year][month])
+
+    def _index_pending_entry(self, key, info):
+        # setdefault keeps an updated entry at its place in the queue
+        self._pending_queue.setdefault(key, info['created_at'])
+        message_id = info.get('confirmation_message_id')
+        if message_id:
+            self._pending_by_message.setdefault(message_id, set()).add(key)
+
+    def _unindex_pending_message(self, key, info):
+        keys = self._pending_by_message.get(info.get('confirmation_message_id'))
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._pending_by_message[info['confirmation_message_id']]
+
+    def get_pending(self, user_id, year, month):
+        """Returns the pending confirmation for a month, or None."""
+        return self.pending.get(str(user_id), {}).get(str(year),
+                                                      {}).get(month)
+
+    def add_pending(self, user_id, year, month, **info):
+        """Registers (or updates) a pending confirmation for a month."""
+        key = (str(user_id), str(year), month)
+        entry = self.pending.setdefault(key[0], {}).setdefault(key[1], {})
+        pending = entry.setdefault(month, {'created_at': int(time.time())})
+        self._unindex_pending_message(key, pending)
+        pending.update(info)
+        self._index_pending_entry(key, pending)
+        self.dirty.add('pending_payments')
+
+    def pending_for_message(self, message_id):
+        """Returns (user_id, year, month) of each month a message confirms."""
+        return list(self._pending_by_message.get(message_id, ()))
+
+    def pending_message_ids(self):
+        """Returns the ids of every confirmation message still pending."""
+        return list(self._pending_by_message)
+
+    def expired_pending(self, cutoff):
+        """Returns (user_id, year, month) made before cutoff, oldest first."""
+        expired = []
+        for key, created_at in self._pending_queue.items():
+            if created_at >= cutoff:
+                break
+            expired.append(key)
+        return expired
+
+    def remove_pending(self, user_id, year, month):
+        """Removes a pending confirmation, dropping empty parents."""
+        user_id = str(user_id)
+        year = str(year)
+        user_pending = self.pending.get(user_id, {})
+        if month not in user_pending.get(year, {}):
+            return None
+        info = user_pending[year].pop(month)
+        self._pending_queue.pop((user_id, year, month), None)
+        self._unindex_pending_message((user_id, year, month), info)
+        if not user_pending[year]:
+            del user_pending[year]
+        if not user_pending:
+            del self.pending[user_id]
+        self.dirty.add('pending_payments')
+        return info
+
+
+def load_nested_payments(path):
+    """Reads payments.json and its year partitions back into one dict.
+
+    Users map to {year: mask}, as in the single-file layout, which is
+    what the SQLite import expects.
+    """
+    payments = load_payments(path)
+    partitions = {}
+    for user_id, years in payments.items():
+        if user_id in RESERVED_KEYS or isinstance(years, dict):
+            continue
+        records = {}
+        for year in mask_to_years(years):
+            if year not in partitions:
+                partitions[year] = load_partition(partition_path(path,
+                                                                 year))[0]
+            records[year] = partitions[year].get(user_id, 0)
+        payments[user_id] = records
+    return payments
+
+
+def open_store(directory='.'):
+    """Creates the store selected by PAYMENTS_BACKEND (json or sqlite)."""
+    backend = os.getenv('PAYMENTS_BACKEND', 'json').lower()
+    if backend == 'sqlite':
+        from sqlite_store import SqlitePaymentStore
+        return SqlitePaymentStore(directory)
+    return PaymentStore(directory)
+
+
+DATA_DIR = 'data'
+# Files of the single-guild layout, moved into the owning guild's directory;
+# the SQLite WAL and shared-memory files hold commits not yet checkpointed
+LEGACY_FILES = ('payments.json', 'payments.journal', 'payments.db',
+                'payments.db-wal', 'payments.db-shm')
+
+
+class GuildStores:
+    """One store per guild, under data/<guild_id>/, loaded on first use.
+
+    Guilds share nothing: each has its own settings, payments, locks and
+    writer, so a large guild never waits on a small one's I/O or locks.
+    """
+
+    def __init__(self, root=DATA_DIR):
+        self.root = root
+        self._stores = {}
+        self._loading = {}
+        # Set once migrate_legacy ran, so no guild store is created before
+        # the legacy files had a chance to move into it
+        self._migrated = asyncio.Event()
+
+    def directory(self, guild_id):
+        return os.path.join(self.root, str(guild_id))
+
+    async def get(self, guild_id):
+        """Returns the guild's loaded store."""
+        guild_id = int(guild_id)
+        store = self._stores.get(guild_id)
+        if store is not None:
+            return store
+        await self._migrated.wait()
+        # Concurrent first uses share a single load
+        task = self._loading.get(guild_id)
+        if task is None:
+            task = self._loading[guild_id] = asyncio.ensure_future(
+                self._open(guild_id))
+        try:
+            return await asyncio.shield(task)
+        finally:
+            self._loading.pop(guild_id, None)
+
+    async def _open(self, guild_id):
+        directory = self.directory(guild_id)
+        os.makedirs(directory, exist_ok=True)
+        store = open_store(directory)
+        await store.load()
+        self._stores[guild_id] = store
+        return store
+
+    def exists(self, guild_id):
+        """Whether the guild has a store, loaded or on disk."""
+        guild_id = int(guild_id)
+        return guild_id in self._stores or os.path.isdir(
+            self.directory(guild_id))
+
+    def loaded(self):
+        """Returns (guild_id, store) for every store loaded so far."""
+        return list(self._stores.items())
+
+    def user_count(self):
+        return sum(store.user_count() for store in self._stores.values())
+
+    def flush(self):
+        """Synchronously writes every loaded store."""
+        for store in self._stores.values():
+            store.flush()
+
+    def migrate_legacy(self, bot, directory='.'):
+        """Moves the single-guild files into the guild that owns them.
+
+        The owner is the guild of any configured channel, or the only
+        guild when no channel resolves. Returns the guild id, or None if
+        there was nothing to migrate (or no owner could be found). Stores
+        can only be opened once this ran.
+        """
+        try:
+            return self._migrate_legacy(bot, directory)
+        finally:
+            self._migrated.set()
+
+    def _migrate_legacy(self, bot, directory):
+        files = [
+            name for name in LEGACY_FILES
+            if os.path.exists(os.path.join(directory, name))
+        ]
+        if not files:
+            return None
+        settings = load_payments(os.path.join(directory,
+                                              PAYMENTS_FILE))['settings']
+        guild_id = None
+        for name in ('commands_channel_id', 'lembrete_channel_id',
+                     'confirmation_channel_id'):
+            channel = bot.get_channel(settings.get(name))
+            if getattr(channel, 'guild', None) is not None:
+                guild_id = channel.guild.id
+                break
+        if guild_id is None and len(bot.guilds) == 1:
+            guild_id = bot.guilds[0].id
+        if guild_id is None:
+            print("Legacy payments.json kept in place: none of its channels "
+                  "belongs to a guild this bot is in.")
+            return None
+        target = self.directory(guild_id)
+        os.makedirs(target, exist_ok=True)
+        if any(os.path.exists(os.path.join(target, name)) for name in files):
+            print(f"Legacy payments.json not migrated: {target} already "
+                  "has payment data.")
+            return None
+        for name in files:
+            shutil.move(os.path.join(directory, name),
+                        os.path.join(target, name))
+        print(f"Legacy payments migrated to guild {guild_id} ({target}).")
+        return guild_id
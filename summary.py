@@ -0,0 +1,76 @@
+import asyncio
+import csv
+import io
+import discord
+from utils import stream_chunks
+
+# Users resolved concurrently while streaming the summary
+RESOLVE_BATCH = 50
+# Rosters larger than this get a CSV attachment in 'auto' mode
+CSV_THRESHOLD = 300
+SUMMARY_MODES = ('auto', 'text', 'csv')
+
+
+async def display_name(bot, user_id):
+    """Returns the user's name, or the id for users that no longer exist."""
+    try:
+        return (await bot.user_cache.get(user_id)).name
+    except discord.NotFound:
+        return user_id
+
+
+async def resolve_statuses(bot, statuses):
+    """Yields (user_id, name, paid) as users are resolved, in roster order."""
+    for start in range(0, len(statuses), RESOLVE_BATCH):
+        batch = statuses[start:start + RESOLVE_BATCH]
+        names = await asyncio.gather(*(display_name(bot, user_id)
+                                       for user_id, _ in batch))
+        for (user_id, paid), name in zip(batch, names):
+            yield user_id, name, paid
+
+
+async def summary_lines(bot, statuses):
+    async for user_id, name, paid in resolve_statuses(bot, statuses):
+        yield f"{name}: {'✅' if paid else '❌'}"
+
+
+async def send_summary_text(bot, channel, statuses, header):
+    """Sends the summary as messages, each one as soon as it fills up."""
+    sent = 0
+    async for chunk in stream_chunks(summary_lines(bot, statuses),
+                                     header=header):
+        await channel.send(chunk)
+        sent += 1
+    if not sent:
+        await channel.send(header + "No registered users.")
+    return sent
+
+
+async def send_summary_csv(bot, channel, statuses, header, filename):
+    """Sends the paid/unpaid totals with the full roster as a CSV file."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(('user_id', 'name', 'paid'))
+    async for user_id, name, paid in resolve_statuses(bot, statuses):
+        writer.writerow((user_id, name, 'yes' if paid else 'no'))
+    paid_count = sum(1 for _, paid in statuses if paid)
+    await channel.send(
+        header +
+        f"{paid_count}/{len(statuses)} paid, {len(statuses) - paid_count} unpaid. Full list attached.",
+        file=discord.File(io.BytesIO(buffer.getvalue().encode('utf-8')),
+                          filename=filename))
+    return 1
+
+
+async def send_summary(bot, store, channel, year, month, mode='auto'):
+    """Sends the month's summary in the given mode; returns the messages sent.
+
+    'text' streams the roster in 2000-character messages, 'csv' attaches
+    it as a file and 'auto' picks csv past CSV_THRESHOLD users.
+    """
+    statuses = await store.month_status(year, month)
+    header = f"**Payment Summary for {month.capitalize()}/{year}**\n"
+    if mode == 'csv' or (mode == 'auto' and len(statuses) > CSV_THRESHOLD):
+        return await send_summary_csv(bot, channel, statuses, header,
+                                      f"summary-{year}-{month}.csv")
+    return await send_summary_text(bot, channel, statuses, header)
@@ -0,0 +1,46 @@
+import asyncio
+import datetime
+from store import PaymentStore
+from utils import (append_journal, journal_path, partition_path,
+                   replay_journal, serialize_journal_entries)
+
+
+def reopen(directory):
+    store = PaymentStore(str(directory))
+    asyncio.run(store.load())
+    return store
+
+
+def test_torn_year_journal_tail_keeps_later_payments(tmp_path):
+    year = str(datetime.date.today().year)
+    store = reopen(tmp_path)
+    store.set_payment_status('222', year, 'janeiro', True)
+    store.flush()
+    # A crash halfway through an append leaves a line without its '\n'
+    with open(journal_path(partition_path(store.path, year)), 'a') as f:
+        f.write('{"key": "222", "val')
+
+    store = reopen(tmp_path)
+
+    async def pay():
+        store.set_payment_status('111', year, 'março', True)
+        await store.save()
+
+    asyncio.run(pay())
+
+    store = reopen(tmp_path)
+    assert store.is_month_paid('111', year, 'march')
+    assert store.is_month_paid('222', year, 'january')
+
+
+def test_append_after_torn_tail_starts_a_new_line(tmp_path):
+    path = str(tmp_path / 'payments.journal')
+    append_journal(serialize_journal_entries([('1', 1)]), path)
+    with open(path, 'a') as f:
+        f.write('{"key": "2", "val')
+
+    append_journal(serialize_journal_entries([('3', 3)]), path)
+
+    payments = {}
+    assert replay_journal(payments, path) == 2
+    assert payments == {'1': 1, '3': 3}
@@ -0,0 +1,102 @@
+import datetime
+import os
+import time
+import zlib
+import zoneinfo
+from scheduler import TIMEZONE
+
+# Reminders go out in 15-minute buckets, a day per turn of the wheel
+BUCKET_SECONDS = 15 * 60
+WHEEL_SIZE = 24 * 60 * 60 // BUCKET_SECONDS
+# Users without a preferred hour are spread over this many hours after the
+# scheduled time (the whole day by default)
+DEFAULT_SPREAD = max(int(os.getenv('REMINDER_SPREAD_HOURS', 24)), 1) * 60 * 60
+
+
+def get_timezone(name):
+    """Returns the tzinfo for a timezone name, or raises ValueError."""
+    try:
+        return zoneinfo.ZoneInfo(name)
+    except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+        raise ValueError(f"Unknown timezone: {name}")
+
+
+def send_time(preference, scheduled, user_id):
+    """Returns when the user's reminder for a scheduled run goes out.
+
+    With a preference, that is the preferred hour of the scheduled day in
+    the user's timezone (the bot's by default), or right away if that
+    hour already passed. Without one, the user gets a fixed bucket in the
+    DEFAULT_SPREAD after the scheduled time, picked by a hash of the id:
+    the low bits of a Discord id are a per-process counter, mostly zero.
+    """
+    if preference is None:
+        buckets = DEFAULT_SPREAD // BUCKET_SECONDS
+        bucket = zlib.crc32(str(user_id).encode()) % buckets
+        return scheduled + datetime.timedelta(seconds=bucket * BUCKET_SECONDS)
+    timezone = TIMEZONE
+    if preference.get('timezone'):
+        try:
+            timezone = get_timezone(preference['timezone'])
+        except ValueError:
+            pass
+    day = scheduled.astimezone(TIMEZONE).date()
+    when = datetime.datetime.combine(day,
+                                     datetime.time(hour=preference['hour']),
+                                     timezone)
+    return max(when, scheduled)
+
+
+class TimingWheel:
+    """A hashed timing wheel: items wait in fixed-size time buckets.
+
+    Adding is O(1) and each tick only looks at its own slot, however many
+    items are queued. Items due more than a turn ahead share a slot with
+    nearer ones and wait for their own turn.
+    """
+
+    def __init__(self,
+                 bucket_seconds=BUCKET_SECONDS,
+                 size=WHEEL_SIZE,
+                 now=None):
+        self.bucket_seconds = bucket_seconds
+        self.slots = [[] for _ in range(size)]
+        # Earliest tick that may still hold items
+        self.cursor = self.tick(now if now is not None else time.time())
+        self.count = 0
+
+    def tick(self, when):
+        return int(when // self.bucket_seconds)
+
+    def bucket_start(self, when):
+        """Returns when the bucket holding the timestamp starts."""
+        return self.tick(when) * self.bucket_seconds
+
+    def add(self, when, item):
+        """Queues item for the bucket of when (a timestamp); past is now."""
+        tick = max(self.tick(when), self.cursor)
+        self.slots[tick % len(self.slots)].append((tick, item))
+        self.count += 1
+        return tick * self.bucket_seconds
+
+    def due(self, now):
+        """Removes and returns [(bucket_start, items)] for buckets up to now.
+
+        The current bucket stays open: items added to it later are
+        returned by the next call.
+        """
+        target = self.tick(now)
+        buckets = []
+        for tick in range(self.cursor, target + 1):
+            slot = self.slots[tick % len(self.slots)]
+            items = [item for item_tick, item in slot if item_tick == tick]
+            if items:
+                slot[:] = [entry for entry in slot if entry[0] != tick]
+                self.count -= len(items)
+                buckets.append((tick * self.bucket_seconds, items))
+        self.cursor = max(self.cursor, target)
+        return buckets
+
+    def next_bucket(self, now):
+        """Returns when the bucket after the current one starts."""
+        return (self.tick(now) + 1) * self.bucket_seconds
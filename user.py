@@ -2,75 +2,166 @@ import discord
 from discord.ext import commands
 from discord.ui import Button, View
 import datetime
-from utils import load_payments, save_payments, ensure_user_month, month_translation, check_command_channel, get_user_payments, set_payment_status, is_month_paid
+from utils import month_translation, check_command_channel
 from views import ConfirmPaymentView
+from timingwheel import get_timezone
+import metrics
 
 
-class PaymentView(View):
+async def register_payment_intention(interaction, store, user_id, year,
+                                     month):
+    """Sends a month for admin confirmation.
 
-    def __init__(self, user_id, year, month):
-        super().__init__(timeout=None)
-        self.user_id = user_id
-        self.year = year
+    Returns an error message, or None if the intention was registered.
+    """
+    async with store.locked(user_id):
+        if store.get_pending(user_id, year, month) is not None:
+            return "This payment is already awaiting admin confirmation."
+        confirmation_channel = interaction.client.get_channel(
+            store.settings.get('confirmation_channel_id'))
+        if not confirmation_channel:
+            return "Confirmation channel not found. Please contact an administrator."
+        message = await confirmation_channel.send(
+            f"{interaction.user.mention} marked {month.capitalize()}/{year} as paid. Administrator, please confirm:",
+            view=ConfirmPaymentView(user_id, year, [month]))
+        store.add_pending(user_id,
+                          year,
+                          month,
+                          confirmation_message_id=message.id)
+    return None
+
+
+class PaymentButton(
+        discord.ui.DynamicItem[discord.ui.Button],
+        template=(r'pay:(?P<action>yes|no):(?:(?P<guild>[0-9]+):)?'
+                  r'(?P<user>[0-9]+):(?P<year>[0-9]+):(?P<month>[0-9]+)')):
+    """Yes/No reminder button whose custom_id carries the guild and month.
+
+    The guild is needed because reminders can be sent by DM; buttons sent
+    before guilds were tracked fall back to the guild they're clicked in.
+    """
+
+    def __init__(self, action, guild_id, user_id, year, month):
+        self.action = action
+        self.guild_id = int(guild_id) if guild_id else None
+        self.user_id = int(user_id)
+        self.year = str(year)
         self.month = month
+        if action == 'yes':
+            button = discord.ui.Button(label="Yes",
+                                       style=discord.ButtonStyle.green)
+        else:
+            button = discord.ui.Button(label="No",
+                                       style=discord.ButtonStyle.red)
+        month_index = list(month_translation.values()).index(month)
+        # Older buttons have no guild segment and keep their custom_id
+        guild = f"{guild_id}:" if guild_id else ""
+        button.custom_id = f"pay:{action}:{guild}{user_id}:{year}:{month_index}"
+        super().__init__(button)
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        month = list(month_translation.values())[int(match['month'])]
+        return cls(match['action'], match['guild'], match['user'],
+                   match['year'], month)
 
-    @discord.ui.button(label="Yes", style=discord.ButtonStyle.green)
-    async def yes_button(self, interaction: discord.Interaction,
-                         button: discord.Button):
+    async def callback(self, interaction: discord.Interaction):
+        with metrics.handler(f"button:pay_{self.action}"):
+            if interaction.user.id != self.user_id:
+                await interaction.response.send_message(
+                    "Only the mentioned user can use this button!")
+                return
+            if self.action == 'yes':
+                await self.yes(interaction)
+            else:
+                await self.no(interaction)
+
+    async def yes(self, interaction: discord.Interaction):
         """Confirms that the user marked the payment."""
-        if interaction.user.id != self.user_id:
+        guild_id = self.guild_id or interaction.guild_id
+        if guild_id is None:
             await interaction.response.send_message(
-                "Only the mentioned user can use this button!")
+                "This reminder has expired. Please use !pagar in the server.")
             return
-        payments = load_payments()
-        user_id_str = str(self.user_id)
-        if 'pending_payments' not in payments:
-            payments['pending_payments'] = {}
-        if user_id_str not in payments['pending_payments']:
-            payments['pending_payments'][user_id_str] = {}
-        if self.year not in payments['pending_payments'][user_id_str]:
-            payments['pending_payments'][user_id_str][self.year] = {}
-        if self.month not in payments['pending_payments'][user_id_str][
-                self.year]:
-            payments['pending_payments'][user_id_str][self.year][
-                self.month] = {}
-            confirmation_channel = interaction.client.get_channel(
-                interaction.client.confirmation_channel_id)
-            if confirmation_channel:
-                message = await confirmation_channel.send(
-                    f"{interaction.user.mention} marked {self.month.capitalize()}/{self.year} as paid. Administrator, please confirm:",
-                    view=ConfirmPaymentView(self.user_id, self.year,
-                                            [self.month]))
-                payments['pending_payments'][user_id_str][self.year][
-                    self.month]['confirmation_message_id'] = message.id
-                save_payments(payments, interaction.client.lembrete_channel_id,
-                              interaction.client.commands_channel_id,
-                              interaction.client.confirmation_channel_id)
-                await interaction.response.edit_message(
-                    content=
-                    f"Payment intention for {self.month.capitalize()} registered! Awaiting admin confirmation.",
-                    view=None)
-            else:
-                await interaction.response.send_message(
-                    "Confirmation channel not found. Please contact an administrator."
-                )
+        store = await interaction.client.stores.get(guild_id)
+        error = await register_payment_intention(interaction, store,
+                                                 self.user_id, self.year,
+                                                 self.month)
+        if error:
+            await interaction.response.send_message(error, ephemeral=True)
+            return
+        await interaction.response.edit_message(
+            content=
+            f"Payment intention for {self.month.capitalize()} registered! Awaiting admin confirmation.",
+            view=None)
 
-    @discord.ui.button(label="No", style=discord.ButtonStyle.red)
-    async def no_button(self, interaction: discord.Interaction,
-                        button: discord.Button):
+    async def no(self, interaction: discord.Interaction):
         """Ignores the payment action."""
-        if interaction.user.id != self.user_id:
-            await interaction.response.send_message(
-                "Only the mentioned user can use this button!")
-            return
         await interaction.response.edit_message(
             content="Payment action ignored.", view=None)
 
 
+class PaymentView(View):
+
+    def __init__(self, guild_id, user_id, year, month):
+        super().__init__(timeout=None)
+        self.add_item(PaymentButton('yes', guild_id, user_id, year, month))
+        self.add_item(PaymentButton('no', guild_id, user_id, year, month))
+
+
+class DigestPaymentButton(
+        discord.ui.DynamicItem[discord.ui.Button],
+        template=r'digest:pay:(?P<year>[0-9]+):(?P<month>[0-9]+)'):
+    """Shared "I've paid" button of a digest reminder.
+
+    Resolves the clicking user, so one button serves every mention.
+    """
+
+    def __init__(self, year, month):
+        self.year = str(year)
+        self.month = month
+        month_index = list(month_translation.values()).index(month)
+        super().__init__(
+            discord.ui.Button(label="I've paid",
+                              style=discord.ButtonStyle.green,
+                              custom_id=f"digest:pay:{year}:{month_index}"))
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        month = list(month_translation.values())[int(match['month'])]
+        return cls(match['year'], month)
+
+    @metrics.instrument("button:digest_pay")
+    async def callback(self, interaction: discord.Interaction):
+        # Digests are only posted in guild channels
+        store = await interaction.client.stores.get(interaction.guild_id)
+        if store.is_month_paid(interaction.user.id, self.year, self.month):
+            await interaction.response.send_message(
+                f"{self.month.capitalize()}/{self.year} is already paid.",
+                ephemeral=True)
+            return
+        error = await register_payment_intention(interaction, store,
+                                                 interaction.user.id,
+                                                 self.year, self.month)
+        await interaction.response.send_message(
+            error or
+            f"Payment intention for {self.month.capitalize()} registered! Awaiting admin confirmation.",
+            ephemeral=True)
+
+
+class DigestPaymentView(View):
+
+    def __init__(self, year, month):
+        super().__init__(timeout=None)
+        self.add_item(DigestPaymentButton(year, month))
+
+
 class UserPaymentsView(View):
 
-    def __init__(self, user_id, year, available_years, invoking_user_id):
+    def __init__(self, store, user_id, year, available_years,
+                 invoking_user_id):
         super().__init__(timeout=60)
+        self.store = store
         self.user_id = user_id
         self.current_year = year
         self.available_years = sorted(available_years, key=int)
@@ -81,6 +172,7 @@ class UserPaymentsView(View):
                                                      key=int)
 
     @discord.ui.button(label="Previous Year", style=discord.ButtonStyle.gray)
+    @metrics.instrument("button:user_prev_year")
     async def prev_button(self, interaction: discord.Interaction,
                           button: discord.Button):
         if interaction.user.id != self.invoking_user_id:
@@ -92,6 +184,7 @@ class UserPaymentsView(View):
         await self.update_message(interaction)
 
     @discord.ui.button(label="Next Year", style=discord.ButtonStyle.gray)
+    @metrics.instrument("button:user_next_year")
     async def next_button(self, interaction: discord.Interaction,
                           button: discord.Button):
         if interaction.user.id != self.invoking_user_id:
@@ -103,6 +196,7 @@ class UserPaymentsView(View):
         await self.update_message(interaction)
 
     @discord.ui.button(label="Close", style=discord.ButtonStyle.red)
+    @metrics.instrument("button:user_close")
     async def close_button(self, interaction: discord.Interaction,
                            button: discord.Button):
         if interaction.user.id != self.invoking_user_id:
@@ -116,12 +210,11 @@ class UserPaymentsView(View):
             await interaction.response.send_message(
                 "Only the user who executed the command can use this button!")
             return
-        payments = get_user_payments(load_payments(), self.user_id,
-                                     self.current_year)
+        # Older years are read from disk on first view
+        await self.store.load_year(self.current_year)
         response = f"**Payments for {interaction.user.name} ({self.current_year})**\n"
-        for mes in month_translation.values():
-            status = "✅" if payments.get(mes, False) else "❌"
-            response += f"{mes.capitalize()}: {status}\n"
+        response += interaction.client.render_cache.get(
+            self.store, self.user_id, self.current_year)
         self.prev_button.disabled = str(self.current_year) == min(
             self.available_years, key=int)
         self.next_button.disabled = str(self.current_year) == max(
@@ -145,48 +238,45 @@ async def pagar(ctx, *, months):
                        )
         return
 
-    payments = load_payments()
+    store = await ctx.bot.stores.get(ctx.guild.id)
     user_id = str(ctx.author.id)
-    if 'pending_payments' not in payments:
-        payments['pending_payments'] = {}
-    if user_id not in payments['pending_payments']:
-        payments['pending_payments'][user_id] = {}
-    if current_year not in payments['pending_payments'][user_id]:
-        payments['pending_payments'][user_id][current_year] = {}
-
-    pending_months = []
-    already_paid = []
-    confirmation_channel = ctx.bot.get_channel(ctx.bot.confirmation_channel_id)
-    commands_channel = ctx.bot.get_channel(ctx.bot.commands_channel_id)
-    for month in valid_months:
-        if not is_month_paid(payments, user_id, current_year, month):
-            if month not in payments['pending_payments'][user_id][
-                    current_year]:
-                payments['pending_payments'][user_id][current_year][month] = {}
-                pending_months.append(month)
-        else:
-            already_paid.append(month)
-
-    if pending_months and confirmation_channel and commands_channel:
-        view = ConfirmPaymentView(ctx.author.id, current_year, pending_months)
-        confirmation_message = await confirmation_channel.send(
-            f"{ctx.author.mention} marked {', '.join(pending_months).capitalize()}/{current_year} as paid. Administrator, please confirm:",
-            view=view)
-        response_message = await ctx.send(
-            f"Payment intention for {', '.join(pending_months).capitalize()} registered! Awaiting admin confirmation."
-        )
-        for month in pending_months:
-            payments['pending_payments'][user_id][current_year][month][
-                'confirmation_message_id'] = confirmation_message.id
-            payments['pending_payments'][user_id][current_year][month][
-                'response_message_id'] = response_message.id
-        save_payments(payments, ctx.bot.lembrete_channel_id,
-                      ctx.bot.commands_channel_id,
-                      ctx.bot.confirmation_channel_id)
-    elif pending_months:
-        await ctx.send(
-            "Confirmation channel or commands channel not found. Please contact an administrator."
-        )
+
+    # Held across the sends so a concurrent !pagar or button click can't
+    # register the same months twice
+    async with store.locked(user_id):
+        pending_months = []
+        already_paid = []
+        confirmation_channel = ctx.bot.get_channel(
+            store.settings.get('confirmation_channel_id'))
+        commands_channel = ctx.bot.get_channel(
+            store.settings.get('commands_channel_id'))
+        for month in valid_months:
+            if not store.is_month_paid(user_id, current_year, month):
+                if store.get_pending(user_id, current_year, month) is None:
+                    pending_months.append(month)
+            else:
+                already_paid.append(month)
+
+        if pending_months and confirmation_channel and commands_channel:
+            view = ConfirmPaymentView(ctx.author.id, current_year,
+                                      pending_months)
+            confirmation_message = await confirmation_channel.send(
+                f"{ctx.author.mention} marked {', '.join(pending_months).capitalize()}/{current_year} as paid. Administrator, please confirm:",
+                view=view)
+            response_message = await ctx.send(
+                f"Payment intention for {', '.join(pending_months).capitalize()} registered! Awaiting admin confirmation."
+            )
+            for month in pending_months:
+                store.add_pending(
+                    user_id,
+                    current_year,
+                    month,
+                    confirmation_message_id=confirmation_message.id,
+                    response_message_id=response_message.id)
+        elif pending_months:
+            await ctx.send(
+                "Confirmation channel or commands channel not found. Please contact an administrator."
+            )
 
     if already_paid:
         await ctx.send(
@@ -201,29 +291,48 @@ async def pagamentos(ctx):
         return
     user_id = ctx.author.id
     current_year = datetime.datetime.now().year
-    payments = load_payments()
-    user_id_str = str(user_id)
+    store = await ctx.bot.stores.get(ctx.guild.id)
 
-    if user_id_str not in payments or user_id_str in ('settings',
-                                                      'pending_payments'):
+    if not store.has_user(user_id):
         await ctx.send("You have no registered payments.")
     else:
-        available_years = [
-            year for year in payments[user_id_str].keys() if year.isdigit()
-        ]
+        available_years = store.get_years(user_id)
         if not available_years:
             await ctx.send("You have no registered years.")
         else:
-            payments_year = get_user_payments(payments, user_id, current_year)
             response = f"**Payments for {ctx.author.name} ({current_year})**\n"
-            for mes in month_translation.values():
-                status = "✅" if payments_year.get(mes, False) else "❌"
-                response += f"{mes.capitalize()}: {status}\n"
-            view = UserPaymentsView(user_id, current_year, available_years,
-                                    ctx.author.id)
+            response += ctx.bot.render_cache.get(store, user_id, current_year)
+            view = UserPaymentsView(store, user_id, current_year,
+                                    available_years, ctx.author.id)
             await ctx.send(response, view=view)
 
 
+@commands.command()
+async def definir_horario(ctx, hour: int = None, timezone: str = None):
+    """Sets the hour (and timezone) the user's reminders are sent at."""
+    if not await check_command_channel(ctx):
+        return
+    if hour is not None and not 0 <= hour <= 23:
+        await ctx.send("Please choose an hour from 0 to 23.")
+        return
+    if timezone is not None:
+        try:
+            get_timezone(timezone)
+        except ValueError:
+            await ctx.send(
+                "Unknown timezone. Please use a name like America/Sao_Paulo.")
+            return
+    store = await ctx.bot.stores.get(ctx.guild.id)
+    store.set_preference(ctx.author.id, hour, timezone)
+    await store.save()
+    if hour is None:
+        await ctx.send("Your reminders are back to the default time.")
+    else:
+        await ctx.send(
+            f"Your reminders will be sent at {hour:02d}:00 ({timezone or 'UTC+1'})."
+        )
+
+
 @commands.command()
 async def ajuda(ctx):
     """Shows the list of commands."""
@@ -235,8 +344,10 @@ async def ajuda(ctx):
     response += "   Marks one or more months as paid, awaiting admin confirmation (e.g., !pagar janeiro fevereiro).\n\n"
     response += "!pagamentos\n"
     response += "   Shows your payment status for the current year.\n\n"
+    response += "!definir_horario [hour] [timezone]\n"
+    response += "   Sets when your reminders arrive (e.g., !definir_horario 9 America/Sao_Paulo); no arguments restores the default.\n\n"
     response += "!todos_pagamentos [Admin]\n"
-    response += "   Shows all users' payments, with page navigation.\n\n"
+    response += "   Shows a grid of all users' payments, filterable by year and unpaid months.\n\n"
     response += "!testar_lembrete [Admin]\n"
     response += "   Sends test reminders to users with the current month unpaid.\n\n"
     response += "!definir_canal_lembrete [Admin]\n"
@@ -245,6 +356,10 @@ async def ajuda(ctx):
     response += "   Sets the channel where commands can be used.\n\n"
     response += "!definir_canal_confirmacao [Admin]\n"
     response += "   Sets the channel for payment confirmations.\n\n"
+    response += "!definir_modo_lembrete <individual|digest> [Admin]\n"
+    response += "   Sends one reminder per user, or digests mentioning many users.\n\n"
+    response += "!definir_modo_resumo <auto|text|csv> [Admin]\n"
+    response += "   Sends the monthly summary as messages, as a CSV file, or picks by roster size.\n\n"
     response += "!ajuda\n"
     response += "   Shows this command list.\n"
     response += "```"
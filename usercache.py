@@ -0,0 +1,47 @@
+import time
+from collections import OrderedDict
+
+USER_CACHE_SIZE = 5000
+USER_CACHE_TTL = 6 * 60 * 60
+
+
+class UserCache:
+    """Resolves users from the gateway cache, then an LRU/TTL cache, then REST.
+
+    fetch_user is an uncached REST call; with the members intent nearly every
+    user we look up is already in bot.get_user once the guilds are chunked.
+    """
+
+    def __init__(self, bot, maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL):
+        self.bot = bot
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._users = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, user_id):
+        """Returns the user, like bot.fetch_user (raises NotFound too)."""
+        user_id = int(user_id)
+        user = self.bot.get_user(user_id)
+        if user is not None:
+            self.hits += 1
+            return user
+        entry = self._users.get(user_id)
+        if entry is not None and entry[1] > time.monotonic():
+            self._users.move_to_end(user_id)
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        user = await self.bot.fetch_user(user_id)
+        self._users[user_id] = (user, time.monotonic() + self.ttl)
+        self._users.move_to_end(user_id)
+        while len(self._users) > self.maxsize:
+            self._users.popitem(last=False)
+        return user
+
+    async def prefetch(self, guild=None):
+        """Loads the guild's (or every guild's) member list in bulk."""
+        for guild in [guild] if guild else self.bot.guilds:
+            if not guild.chunked:
+                await guild.chunk()
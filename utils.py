@@ -1,6 +1,8 @@
+import asyncio
 import json
 import os
-import datetime
+import time
+import metrics
 from discord.ext import commands
 
 # Tradução de meses
@@ -20,106 +22,414 @@ month_translation = {
 }
 
 
-def load_payments():
-    """Carrega os dados do payments.json."""
-    if not os.path.exists('payments.json'):
-        return {'settings': {}, 'pending_payments': {}}
+PAYMENTS_FILE = 'payments.json'
+JOURNAL_FILE = 'payments.journal'
+# Chaves do payments.json que não são usuários
+RESERVED_KEYS = ('settings', 'pending_payments', 'reminder_preferences')
+
+
+# Bit de cada mês na máscara anual de pagamentos (janeiro = bit 0)
+month_bits = {
+    month: 1 << i
+    for i, month in enumerate(month_translation.values())
+}
+
+
+def months_to_mask(months):
+    """Converte meses (em português) numa máscara de 12 bits."""
+    month_names = list(month_translation.values())
+    mask = 0
+    for month in months:
+        mask |= 1 << month_names.index(month)
+    return mask
+
+
+def mask_to_months(mask):
+    """Converte uma máscara de 12 bits na lista de meses, por ordem."""
+    return [
+        month for i, month in enumerate(month_translation.values())
+        if mask >> i & 1
+    ]
+
+
+# Os anos de cada usuário também ficam numa máscara (YEAR_BASE = bit 0)
+YEAR_BASE = 2000
+
+
+def year_bit(year):
+    """Bit de um ano na máscara de anos de um usuário."""
+    return 1 << (int(year) - YEAR_BASE)
+
+
+def mask_to_years(mask):
+    """Converte uma máscara de anos na lista de anos, do mais antigo."""
+    years = []
+    year = YEAR_BASE
+    while mask:
+        if mask & 1:
+            years.append(str(year))
+        mask >>= 1
+        year += 1
+    return years
+
+
+def journal_path(path):
+    """Caminho do journal que acompanha um snapshot (payments.journal)."""
+    return os.path.splitext(path)[0] + '.journal'
+
+
+def partition_path(path, year):
+    """Caminho do snapshot de um ano (payments-2024.json)."""
+    root, extension = os.path.splitext(path)
+    return f"{root}-{year}{extension}"
+
+
+def load_payments(path=PAYMENTS_FILE):
+    """Carrega o snapshot do payments.json e reaplica o journal."""
+    return load_snapshot(path, {key: {} for key in RESERVED_KEYS})[0]
+
+
+def load_partition(path):
+    """Carrega o snapshot de um ano (usuário -> máscara) e o seu journal.
+
+    Devolve (máscaras, entradas reaplicadas do journal).
+    """
+    return load_snapshot(path, {})
+
+
+def load_snapshot(path, payments):
+    """Lê um snapshot JSON (ou usa o valor dado) e reaplica o journal.
+
+    Devolve (dados, entradas reaplicadas do journal).
+    """
+    started = time.perf_counter()
+    if os.path.exists(path):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                content = f.read().strip()
+            metrics.inc('storage_bytes_total',
+                        len(content.encode('utf-8')),
+                        op='load')
+            if content:
+                payments = json.loads(content)
+        except json.JSONDecodeError:
+            # Nunca sobrescreve o ledger: guarda a cópia corrompida à parte
+            corrupt_path = path + '.corrupt'
+            os.replace(path, corrupt_path)
+            print(f"JSON corrompido, cópia guardada em {corrupt_path}.")
+    replayed = replay_journal(payments, journal_path(path))
+    metrics.observe('storage_seconds', time.perf_counter() - started,
+                    op='load')
+    return payments, replayed
+
+
+def replay_journal(payments, path=JOURNAL_FILE):
+    """Reaplica no dicionário as alterações registadas no journal.
+
+    Uma última linha sem quebra de linha (crash a meio da escrita) é
+    cortada do ficheiro, para que o próximo append não a junte à entrada
+    seguinte.
+    """
+    if not os.path.exists(path):
+        return 0
+    replayed = 0
+    complete = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            complete += len(line)
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                print("Entrada inválida no journal ignorada.")
+                continue
+            if entry['value'] is None:
+                payments.pop(entry['key'], None)
+            else:
+                payments[entry['key']] = entry['value']
+            replayed += 1
+    if complete < os.path.getsize(path):
+        print(f"Entrada incompleta no fim de {path} descartada.")
+        with open(path, 'r+b') as f:
+            f.truncate(complete)
+    return replayed
+
+
+def journal_has_entries(path=JOURNAL_FILE):
+    """Indica se há alterações no journal ainda fora do snapshot."""
+    return os.path.exists(path) and os.path.getsize(path) > 0
+
+
+def serialize_journal_entries(entries):
+    """Serializa pares (chave, valor) como linhas do journal."""
+    return ''.join(
+        json.dumps({
+            'key': key,
+            'value': value
+        }, ensure_ascii=False) + '\n' for key, value in entries)
+
+
+def append_journal(content, path=JOURNAL_FILE):
+    """Acrescenta entradas ao journal e força-as para o disco.
+
+    Se o journal não acaba numa quebra de linha (crash a meio da escrita),
+    as entradas começam numa linha nova em vez de colarem na incompleta.
+    """
+    started = time.perf_counter()
     try:
-        with open('payments.json', 'r', encoding='utf-8') as f:
-            content = f.read().strip()
-            if not content:
-                return {'settings': {}, 'pending_payments': {}}
-            return json.loads(content)
-    except json.JSONDecodeError:
-        print("JSON corrompido, recriando arquivo.")
-        save_payments({
-            'settings': {},
-            'pending_payments': {}
-        }, None, None, None)
-        return {'settings': {}, 'pending_payments': {}}
-
-
-def save_payments(payments, lembrete_channel_id, commands_channel_id,
-                  confirmation_channel_id):
-    """Salva os dados no payments.json."""
+        data = content.encode('utf-8')
+        with open(path, 'a+b') as f:
+            if os.fstat(f.fileno()).st_size:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    data = b'\n' + data
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        metrics.observe('storage_seconds', time.perf_counter() - started,
+                        op='journal')
+        metrics.inc('storage_bytes_total', len(data), op='journal')
+        return True
+    except Exception as e:
+        print(f"Erro ao gravar {path}: {e}")
+        return False
+
+
+def atomic_write(path, content):
+    """Escreve num ficheiro temporário e renomeia-o por cima do destino."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def serialize_payments(payments, lembrete_channel_id, commands_channel_id,
+                       confirmation_channel_id):
+    """Serializa os dados com as configurações atuais dos canais."""
+    if 'settings' not in payments:
+        payments['settings'] = {}
+    if 'pending_payments' not in payments:
+        payments['pending_payments'] = {}
+    payments['settings']['lembrete_channel_id'] = lembrete_channel_id
+    payments['settings']['commands_channel_id'] = commands_channel_id
+    payments['settings']['confirmation_channel_id'] = confirmation_channel_id
+    # Sem indent o json usa o encoder em C, bem mais rápido
+    return json.dumps(payments, ensure_ascii=False)
+
+
+def write_payments_file(content, path=PAYMENTS_FILE):
+    """Grava um snapshot compactado e descarta o journal que ele substitui."""
+    started = time.perf_counter()
     try:
-        with open('payments.json', 'w', encoding='utf-8') as f:
-            if 'settings' not in payments:
-                payments['settings'] = {}
-            if 'pending_payments' not in payments:
-                payments['pending_payments'] = {}
-            payments['settings']['lembrete_channel_id'] = lembrete_channel_id
-            payments['settings']['commands_channel_id'] = commands_channel_id
-            payments['settings'][
-                'confirmation_channel_id'] = confirmation_channel_id
-            json.dump(payments, f, indent=4, ensure_ascii=False)
+        atomic_write(path, content)
+        if os.path.exists(journal_path(path)):
+            open(journal_path(path), 'w').close()
+        metrics.observe('storage_seconds', time.perf_counter() - started,
+                        op='snapshot')
+        metrics.inc('storage_bytes_total',
+                    len(content.encode('utf-8')),
+                    op='snapshot')
+        return True
     except Exception as e:
-        print(f"Erro ao salvar payments.json: {e}")
-
-
-def ensure_user_month(payments, user_id, year, month):
-    """Garante que um usuário tenha uma entrada para o ano/mês."""
-    user_id = str(user_id)
-    year = str(year)
-    if user_id not in payments or user_id in ('settings', 'pending_payments'):
-        payments[user_id] = {}
-    if year not in payments[user_id]:
-        payments[user_id][year] = {
-            m: False
-            for m in month_translation.values()
-        }
-    if month not in payments[user_id][year]:
-        payments[user_id][year][month] = False
-
-
-def set_payment_status(payments, user_id, year, month, status):
-    """Define o status de pagamento de um mês."""
-    user_id = str(user_id)
-    year = str(year)
-    ensure_user_month(payments, user_id, year, month)
-    payments[user_id][year][month] = status
-
-
-def is_month_paid(payments, user_id, year, month_en):
-    """Verifica se um mês está pago."""
-    user_id = str(user_id)
-    year = str(year)
-    month_pt = month_translation.get(month_en.lower(), month_en.lower())
-    ensure_user_month(payments, user_id, year, month_pt)
-    return payments[user_id][year][month_pt]
-
-
-def get_user_payments(payments, user_id, year):
-    """Retorna os pagamentos de um usuário para um ano."""
-    user_id = str(user_id)
-    year = str(year)
-    ensure_user_month(payments, user_id, year, 'janeiro')
-    return payments[user_id][year]
-
-
-def reset_payments(payments):
-    """Reseta os pagamentos para o ano atual."""
-    current_year = str(datetime.datetime.now().year)
-    for user_id in list(payments.keys()):
-        if user_id not in ('settings', 'pending_payments'):
-            payments[user_id] = {
-                current_year: {
-                    month: False
-                    for month in month_translation.values()
-                }
-            }
+        print(f"Erro ao salvar {path}: {e}")
+        return False
+
+
+def save_payments(payments,
+                  lembrete_channel_id,
+                  commands_channel_id,
+                  confirmation_channel_id,
+                  path=PAYMENTS_FILE):
+    """Salva os dados no payments.json."""
+    return write_payments_file(
+        serialize_payments(payments, lembrete_channel_id, commands_channel_id,
+                           confirmation_channel_id), path)
+
+
+def save_partition(masks, path):
+    """Salva o snapshot de um ano."""
+    return write_payments_file(json.dumps(masks, ensure_ascii=False), path)
+
+
+def compact_partition(path):
+    """Funde o journal de um ano no seu snapshot, se tiver alterações."""
+    if not journal_has_entries(journal_path(path)):
+        return True
+    return save_partition(load_partition(path)[0], path)
+
+
+class PaymentWriter:
+    """Executa as gravações em ordem numa task dedicada, fora do event loop."""
+
+    def __init__(self):
+        self._queue = None
+        self._task = None
+
+    def submit(self, func, *args):
+        """Agenda func(*args) num executor e devolve um Future com o resultado.
+
+        Sem event loop ativo (ex.: no encerramento) a função roda na hora.
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            func(*args)
+            return None
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue()
+            self._task = loop.create_task(self._run())
+        future = loop.create_future()
+        self._queue.put_nowait((func, args, future))
+        return future
+
+    async def close(self):
+        """Espera as gravações em fila e encerra a task."""
+        if self._task is None or self._task.done():
+            return
+        await self.submit(bool)
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            func, args, future = await self._queue.get()
+            started = time.perf_counter()
+            try:
+                result = await loop.run_in_executor(None, func, *args)
+            except Exception as e:
+                print(f"Erro na gravação em segundo plano: {e}")
+                result = False
+            metrics.set_gauge('last_save_seconds',
+                              time.perf_counter() - started)
+            if not future.done():
+                future.set_result(result)
+
+
+payment_writer = PaymentWriter()
+
+
+async def load_payments_async(path=PAYMENTS_FILE):
+    """Carrega o payments.json sem bloquear o event loop."""
+    return await asyncio.get_running_loop().run_in_executor(
+        None, load_payments, path)
+
+
+def append_journal_async(entries, path=JOURNAL_FILE, writer=payment_writer):
+    """Grava pares (chave, valor) no journal em segundo plano."""
+    return writer.submit(append_journal, serialize_journal_entries(entries),
+                         path)
+
+
+def save_payments_async(payments,
+                        lembrete_channel_id,
+                        commands_channel_id,
+                        confirmation_channel_id,
+                        path=PAYMENTS_FILE,
+                        writer=payment_writer):
+    """Serializa os dados e grava-os em segundo plano, na ordem de chamada.
+
+    Devolve um Future que pode ser aguardado ou ignorado.
+    """
+    content = serialize_payments(payments, lembrete_channel_id,
+                                 commands_channel_id, confirmation_channel_id)
+    return writer.submit(write_payments_file, content, path)
+
+
+def save_partition_async(masks, path, writer=payment_writer):
+    """Serializa um ano e grava-o em segundo plano."""
+    return writer.submit(write_payments_file,
+                         json.dumps(masks, ensure_ascii=False), path)
+
+
+def migrate_payment_masks(payments):
+    """Converte anos no formato antigo (mês -> bool) em máscaras de bits.
+
+    Devolve quantos anos foram convertidos.
+    """
+    converted = 0
+    for user_id, years in payments.items():
+        if user_id in RESERVED_KEYS or not isinstance(years, dict):
+            continue
+        for year, months in years.items():
+            if isinstance(months, dict):
+                years[year] = months_to_mask(
+                    month for month, paid in months.items()
+                    if paid and month in month_bits)
+                converted += 1
+    return converted
+
+
+class LineChunker:
+    """Junta linhas numa mensagem até ela atingir o limite do Discord."""
+
+    def __init__(self, header='', limit=2000, max_lines=None, separator='\n'):
+        self.header = header
+        self.limit = limit
+        self.max_lines = max_lines
+        self.separator = separator
+        self.current = header
+        self.count = 0
+
+    def add(self, line):
+        """Acrescenta uma linha; devolve a mensagem anterior se ela encheu."""
+        full = None
+        joiner = self.separator if self.count else ''
+        if self.count and (
+                len(self.current) + len(joiner) + len(line) > self.limit or
+            (self.max_lines and self.count >= self.max_lines)):
+            full = self.current
+            self.current = self.header
+            self.count = 0
+            joiner = ''
+        self.current += joiner + line
+        self.count += 1
+        return full
+
+    def finish(self):
+        """Devolve a última mensagem, ou None se não sobrou nenhuma linha."""
+        return self.current if self.count else None
+
+
+def chunk_lines(lines, header='', limit=2000, max_lines=None, separator='\n'):
+    """Agrupa linhas em mensagens que respeitam o limite do Discord."""
+    chunker = LineChunker(header, limit, max_lines, separator)
+    chunks = [chunk for chunk in map(chunker.add, lines) if chunk]
+    if chunker.finish():
+        chunks.append(chunker.finish())
+    return chunks
+
+
+async def stream_chunks(lines, header='', limit=2000, max_lines=None,
+                        separator='\n'):
+    """Versão assíncrona de chunk_lines: entrega cada mensagem assim que enche."""
+    chunker = LineChunker(header, limit, max_lines, separator)
+    async for line in lines:
+        chunk = chunker.add(line)
+        if chunk:
+            yield chunk
+    if chunker.finish():
+        yield chunker.finish()
 
 
 async def check_command_channel(ctx):
-    """Verifica se o comando foi usado no canal correto."""
-    if ctx.bot.commands_channel_id and ctx.channel.id != ctx.bot.commands_channel_id:
+    """Verifica se o comando foi usado no canal correto do servidor."""
+    store = await ctx.bot.stores.get(ctx.guild.id)
+    commands_channel_id = store.settings.get('commands_channel_id')
+    if commands_channel_id and ctx.channel.id != commands_channel_id:
         if ctx.command.name in (
                 'definir_canal_comandos', 'definir_canal_lembrete',
                 'definir_canal_confirmacao'
         ) and ctx.author.guild_permissions.administrator:
             return True
         await ctx.author.send(
-            f"Por favor, use os comandos no canal <#{ctx.bot.commands_channel_id}>."
+            f"Por favor, use os comandos no canal <#{commands_channel_id}>."
         )
         return False
     return True
@@ -1,151 +1,159 @@
+import asyncio
 import discord
 from discord.ui import Button, View
-from utils import load_payments, save_payments, set_payment_status
+from utils import months_to_mask, mask_to_months
+import metrics
 
 
-class ConfirmPaymentView(View):
+class ConfirmPaymentButton(
+        discord.ui.DynamicItem[discord.ui.Button],
+        template=(r'confirm:(?P<action>ok|deny):(?P<user>[0-9]+):'
+                  r'(?P<year>[0-9]+):(?P<months>[0-9a-f]+)')):
+    """Confirm/Deny button whose custom_id carries user, year and months.
 
-    def __init__(self, user_id, year, months):
-        super().__init__(timeout=None)
-        self.user_id = user_id
-        self.year = year
+    Registered once with bot.add_dynamic_items, so buttons keep working
+    after a restart and no per-message view is kept in memory.
+    """
+
+    def __init__(self, action, user_id, year, months):
+        self.action = action
+        self.user_id = int(user_id)
+        self.year = str(year)
         self.months = months
+        if action == 'ok':
+            button = discord.ui.Button(label="Confirmar",
+                                       style=discord.ButtonStyle.green)
+        else:
+            button = discord.ui.Button(label="Deny",
+                                       style=discord.ButtonStyle.red)
+        button.custom_id = f"confirm:{action}:{user_id}:{year}:{months_to_mask(months):x}"
+        super().__init__(button)
 
-    @discord.ui.button(label="Confirmar", style=discord.ButtonStyle.green)
-    async def confirm_button(self, interaction: discord.Interaction,
-                             button: discord.Button):
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(match['action'], match['user'], match['year'],
+                   mask_to_months(int(match['months'], 16)))
+
+    async def callback(self, interaction: discord.Interaction):
+        with metrics.handler(f"button:confirm_{self.action}"):
+            if self.action == 'ok':
+                await self.confirm(interaction)
+            else:
+                await self.deny(interaction)
+
+    async def confirm(self, interaction: discord.Interaction):
         """Confirms a user's payment."""
         if not interaction.user.guild_permissions.administrator:
             await interaction.response.send_message(
                 "Only administrators can confirm payments!")
             return
-        payments = load_payments()
         user_id_str = str(self.user_id)
-        confirmation_channel = interaction.client.get_channel(
-            interaction.client.confirmation_channel_id)
-        commands_channel = interaction.client.get_channel(
-            interaction.client.commands_channel_id)
-        for month in self.months:
-            set_payment_status(payments, user_id_str, self.year, month, True)
-            if 'pending_payments' in payments and user_id_str in payments[
-                    'pending_payments']:
-                if self.year in payments['pending_payments'][user_id_str]:
-                    if month in payments['pending_payments'][user_id_str][
-                            self.year]:
-                        # Update the confirmation channel message
-                        confirmation_message_id = payments['pending_payments'][
-                            user_id_str][self.year][month].get(
-                                'confirmation_message_id')
-                        if confirmation_message_id and confirmation_channel:
-                            try:
-                                confirmation_message = await confirmation_channel.fetch_message(
-                                    confirmation_message_id)
-                                await confirmation_message.edit(
-                                    content=
-                                    f"Payment for {month.capitalize()}/{self.year} accepted by admin.",
-                                    view=None)
-                            except discord.errors.NotFound:
-                                print(
-                                    f"Confirmation message {confirmation_message_id} not found."
-                                )
-                        # Update the commands channel response message
-                        response_message_id = payments['pending_payments'][
-                            user_id_str][self.year][month].get(
-                                'response_message_id')
-                        if response_message_id and commands_channel:
-                            try:
-                                response_message = await commands_channel.fetch_message(
-                                    response_message_id)
-                                await response_message.edit(
-                                    content=
-                                    f"Payment intention for {month.capitalize()} registered! Admin accepted the confirmation."
-                                )
-                            except discord.errors.NotFound:
-                                print(
-                                    f"Response message {response_message_id} not found."
-                                )
-                        # Remove the pending payment
-                        del payments['pending_payments'][user_id_str][
-                            self.year][month]
-                        if not payments['pending_payments'][user_id_str][
-                                self.year]:
-                            del payments['pending_payments'][user_id_str][
-                                self.year]
-                        if not payments['pending_payments'][user_id_str]:
-                            del payments['pending_payments'][user_id_str]
-        save_payments(payments, interaction.client.lembrete_channel_id,
-                      interaction.client.commands_channel_id,
-                      interaction.client.confirmation_channel_id)
-        user = await interaction.client.fetch_user(int(user_id_str))
+        store = await interaction.client.stores.get(interaction.guild_id)
+        # Waits for a !pagar or Yes click still registering this user's
+        # months, and makes a second admin click see them as handled
+        async with store.locked(user_id_str):
+            handled = {}
+            for month in self.months:
+                pending = store.remove_pending(user_id_str, self.year, month)
+                if pending is not None:
+                    store.set_payment_status(user_id_str, self.year, month,
+                                             True)
+                    handled[month] = pending
+        if not handled:
+            await interaction.response.send_message(
+                "This payment was already handled by another administrator.",
+                ephemeral=True)
+            return
+        await self.update_pending_messages(interaction, store, handled,
+                                           "accepted")
+        user = await interaction.client.user_cache.get(int(user_id_str))
         await interaction.response.edit_message(
             content=
             f"Payment for {', '.join(self.months).capitalize()}/{self.year} from {user.mention} confirmed!",
             view=None)
 
-    @discord.ui.button(label="Deny", style=discord.ButtonStyle.red)
-    async def deny_button(self, interaction: discord.Interaction,
-                          button: discord.Button):
+    async def deny(self, interaction: discord.Interaction):
         """Denies a user's payment."""
         if not interaction.user.guild_permissions.administrator:
             await interaction.response.send_message(
                 "Only administrators can deny payments!")
             return
-        payments = load_payments()
         user_id_str = str(self.user_id)
-        confirmation_channel = interaction.client.get_channel(
-            interaction.client.confirmation_channel_id)
-        commands_channel = interaction.client.get_channel(
-            interaction.client.commands_channel_id)
-        if 'pending_payments' in payments and user_id_str in payments[
-                'pending_payments']:
-            if self.year in payments['pending_payments'][user_id_str]:
-                for month in self.months:
-                    if month in payments['pending_payments'][user_id_str][
-                            self.year]:
-                        # Update the confirmation channel message
-                        confirmation_message_id = payments['pending_payments'][
-                            user_id_str][self.year][month].get(
-                                'confirmation_message_id')
-                        if confirmation_message_id and confirmation_channel:
-                            try:
-                                confirmation_message = await confirmation_channel.fetch_message(
-                                    confirmation_message_id)
-                                await confirmation_message.edit(
-                                    content=
-                                    f"Payment for {month.capitalize()}/{self.year} denied by admin.",
-                                    view=None)
-                            except discord.errors.NotFound:
-                                print(
-                                    f"Confirmation message {confirmation_message_id} not found."
-                                )
-                        # Update the commands channel response message
-                        response_message_id = payments['pending_payments'][
-                            user_id_str][self.year][month].get(
-                                'response_message_id')
-                        if response_message_id and commands_channel:
-                            try:
-                                response_message = await commands_channel.fetch_message(
-                                    response_message_id)
-                                await response_message.edit(
-                                    content=
-                                    f"Payment intention for {month.capitalize()} registered! Admin denied the confirmation."
-                                )
-                            except discord.errors.NotFound:
-                                print(
-                                    f"Response message {response_message_id} not found."
-                                )
-                        # Remove the pending payment
-                        del payments['pending_payments'][user_id_str][
-                            self.year][month]
-                if not payments['pending_payments'][user_id_str][self.year]:
-                    del payments['pending_payments'][user_id_str][self.year]
-                if not payments['pending_payments'][user_id_str]:
-                    del payments['pending_payments'][user_id_str]
-        save_payments(payments, interaction.client.lembrete_channel_id,
-                      interaction.client.commands_channel_id,
-                      interaction.client.confirmation_channel_id)
-        user = await interaction.client.fetch_user(int(user_id_str))
+        store = await interaction.client.stores.get(interaction.guild_id)
+        async with store.locked(user_id_str):
+            handled = {}
+            for month in self.months:
+                pending = store.remove_pending(user_id_str, self.year, month)
+                if pending is not None:
+                    handled[month] = pending
+        if not handled:
+            await interaction.response.send_message(
+                "This payment was already handled by another administrator.",
+                ephemeral=True)
+            return
+        await self.update_pending_messages(interaction, store, handled,
+                                           "denied")
+        user = await interaction.client.user_cache.get(int(user_id_str))
         await interaction.response.edit_message(
             content=
             f"Payment for {', '.join(self.months).capitalize()}/{self.year} from {user.mention} denied.",
             view=None)
+
+    async def update_pending_messages(self, interaction, store, handled,
+                                      outcome):
+        """Edits the messages of the handled months, once per message.
+
+        Months from the same !pagar share both message ids, so the edits
+        are grouped by id and sent concurrently. The clicked message is
+        skipped: the interaction response replaces it anyway.
+        """
+        confirmation_channel = interaction.client.get_channel(
+            store.settings.get('confirmation_channel_id'))
+        commands_channel = interaction.client.get_channel(
+            store.settings.get('commands_channel_id'))
+        confirmation_months = {}
+        response_months = {}
+        for month, pending in handled.items():
+            confirmation_message_id = pending.get('confirmation_message_id')
+            if (confirmation_message_id
+                    and confirmation_message_id != interaction.message.id):
+                confirmation_months.setdefault(confirmation_message_id,
+                                               []).append(month)
+            response_message_id = pending.get('response_message_id')
+            if response_message_id:
+                response_months.setdefault(response_message_id,
+                                           []).append(month)
+
+        edits = []
+        if confirmation_channel:
+            for message_id, months in confirmation_months.items():
+                edits.append(
+                    self._edit(
+                        confirmation_channel, message_id,
+                        f"Payment for {', '.join(months).capitalize()}/{self.year} {outcome} by admin.",
+                        view=None))
+        if commands_channel:
+            for message_id, months in response_months.items():
+                edits.append(
+                    self._edit(
+                        commands_channel, message_id,
+                        f"Payment intention for {', '.join(months).capitalize()} registered! Admin {outcome} the confirmation."
+                    ))
+        await asyncio.gather(*edits)
+
+    @staticmethod
+    async def _edit(channel, message_id, content, **kwargs):
+        # A partial message edits without fetching the message first
+        try:
+            await channel.get_partial_message(message_id).edit(
+                content=content, **kwargs)
+        except discord.errors.NotFound:
+            print(f"Message {message_id} not found.")
+
+
+class ConfirmPaymentView(View):
+
+    def __init__(self, user_id, year, months):
+        super().__init__(timeout=None)
+        self.add_item(ConfirmPaymentButton('ok', user_id, year, months))
+        self.add_item(ConfirmPaymentButton('deny', user_id, year, months))
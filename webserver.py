@@ -1,18 +1,66 @@
-from flask import Flask
-import threading
+import math
+import os
+from aiohttp import web
+import metrics
 
-app = Flask(__name__)
+bot_key = web.AppKey('bot', object)
 
+# /health answers 503 when the loop is this far behind
+MAX_LOOP_LAG = 1.0
 
-@app.route('/')
-def home():
-    return "Bot está rodando!"
 
+async def home(request):
+    return web.Response(text="Bot está rodando!")
 
-def run():
-    app.run(host='0.0.0.0', port=8080)
 
+async def health(request):
+    """Reports gateway, event loop, store and job metrics as JSON."""
+    bot = request.app[bot_key]
+    latency = bot.latency
+    data = {
+        'ready': bot.is_ready(),
+        'gateway_latency_seconds': latency if math.isfinite(latency) else None,
+        'guilds': len(bot.guilds),
+        'store_users': bot.stores.user_count(),
+        'stores_loaded': len(bot.stores.loaded()),
+        'reminders_queued': bot.reminder_wheel.count,
+        **metrics.gauges,
+    }
+    healthy = (data['ready'] and metrics.gauges.get(
+        'event_loop_lag_seconds', 0) < MAX_LOOP_LAG)
+    return web.json_response(data, status=200 if healthy else 503)
 
-def keep_alive():
-    t = threading.Thread(target=run)
-    t.start()
+
+async def prometheus(request):
+    """Exports the metrics in the Prometheus text format."""
+    bot = request.app[bot_key]
+    if math.isfinite(bot.latency):
+        metrics.set_gauge('gateway_latency_seconds', bot.latency)
+    metrics.set_gauge('store_users', bot.stores.user_count())
+    metrics.set_gauge('stores_loaded', len(bot.stores.loaded()))
+    metrics.set_gauge('reminders_queued', bot.reminder_wheel.count)
+    return web.Response(text=metrics.prometheus_text(),
+                        content_type='text/plain')
+
+
+async def start_webserver(bot):
+    """Serves the health endpoints from the bot's own event loop.
+
+    Returns the runner, or None if the port can't be bound: the bot keeps
+    running without the endpoints.
+    """
+    app = web.Application()
+    app[bot_key] = bot
+    app.router.add_get('/', home)
+    app.router.add_get('/health', health)
+    app.router.add_get('/metrics', prometheus)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    port = int(os.getenv('PORT', 8080))
+    try:
+        await web.TCPSite(runner, '0.0.0.0', port).start()
+    except OSError as e:
+        print(f"Health server not started on port {port}: {e}")
+        await runner.cleanup()
+        return None
+    return runner